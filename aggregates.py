@@ -0,0 +1,141 @@
+# precomputed summary tables derived from acoustic_features
+#
+# these are built once (at startup or via `python aggregates.py <db>`) and rebuilt
+# whenever the source table changes, so the app never has to scan the full corpus
+# on a rerun.
+
+import sys
+import time
+import sqlite3
+from sqlite3 import Connection
+
+import pandas as pd
+
+from db import FEATURES, bump_data_version
+
+def source_fingerprint(conn: Connection):
+  # "has acoustic_features changed since the last build?": the data version writers bump
+  # when they're done (db.bump_data_version). row count / max rowid missed in-place updates
+  return str(conn.execute('pragma user_version').fetchone()[0])
+
+def _ensure_meta(conn: Connection):
+  conn.execute('''
+    create table if not exists derived_meta (
+      name text primary key,
+      source text,
+      built_at real
+    )
+  ''')
+
+def mark_built(conn: Connection, name):
+  # record which version of acoustic_features a derived table was built from
+  _ensure_meta(conn)
+  conn.execute(
+    'insert or replace into derived_meta (name, source, built_at) values (?, ?, ?)',
+    (name, source_fingerprint(conn), time.time())
+  )
+
+def is_fresh(conn: Connection, name):
+  try:
+    row = conn.execute('select source from derived_meta where name = ?', (name,)).fetchone()
+  except sqlite3.OperationalError: # no derived_meta yet
+    return False
+  return row is not None and row[0] == source_fingerprint(conn)
+
+def publish(conn: Connection, rebuilt=None):
+  """
+  Ends a write: bumps the data version and keeps the derived tables in `rebuilt`
+  (already built from the new data) fresh under it, in one transaction, so readers
+  never see the new version with those tables marked stale. rebuilt=None: the write
+  didn't touch acoustic_features, every table that was fresh stays fresh.
+  """
+  _ensure_meta(conn)
+  with conn:
+    old = source_fingerprint(conn)
+    new = str(int(old) + 1)
+    if rebuilt is None:
+      conn.execute('update derived_meta set source = ? where source = ?', (new, old))
+    else:
+      conn.executemany('update derived_meta set source = ? where name = ? and source = ?', [(new, name, old) for name in rebuilt])
+    bump_data_version(conn)
+
+def build_decade_trends(conn: Connection):
+  # one row per decade (ten_year_group = year / 10, same grouping as the old inline query)
+  averages = ', '.join(f'avg({feature}) as {feature}' for feature in FEATURES)
+  with conn:
+    conn.execute('drop table if exists decade_trends')
+    conn.execute(f'''
+      create table decade_trends as
+      select
+        substr(date, 1, 4) / 10 as ten_year_group,
+        count(*) as n,
+        {averages}
+      from acoustic_features
+      group by 1
+    ''')
+    conn.execute('create unique index if not exists decade_trends_group on decade_trends (ten_year_group)')
+    mark_built(conn, 'decade_trends')
+
+def ensure_decade_trends(conn: Connection):
+  if not is_fresh(conn, 'decade_trends'):
+    build_decade_trends(conn)
+
+ALBUM_KEYS = ('artist', 'album', 'date')
+SUMMARY_STATS = ('n', 'mean', 'median', 'min', 'max', 'std', 'q25', 'q75')
+
+def summarize_albums(df):
+  # long format, one row per (artist, album, date, feature); n counts the tracks
+  # that have a value for the feature, std is the sample standard deviation
+  keys = list(ALBUM_KEYS)
+  values = df.melt(id_vars=keys, value_vars=list(FEATURES), var_name='feature')
+  grouped = values.groupby(keys + ['feature'], sort=False)['value']
+  summary = grouped.agg(n='count', mean='mean', median='median', min='min', max='max', std='std')
+  summary['q25'] = grouped.quantile(0.25)
+  summary['q75'] = grouped.quantile(0.75)
+  return summary.reset_index()
+
+def build_album_summary(conn: Connection, chunk_rows=500000):
+  # every statistic of every feature per album release, in one pass over acoustic_features.
+  # rows stream in (artist, album, date) order, so a chunk only holds back its last,
+  # possibly unfinished, album for the next one and memory stays bounded.
+  # undated tracks are left out: they can't be placed on the date-ordered charts
+  keys = list(ALBUM_KEYS)
+  columns = keys + list(FEATURES)
+  stats = ', '.join(f'"{name}" real' for name in SUMMARY_STATS[1:])
+  insert = f'insert into album_summary values ({", ".join("?" * (len(keys) + 1 + len(SUMMARY_STATS)))})'
+
+  with conn:
+    conn.execute('drop table if exists album_summary')
+    conn.execute(f'create table album_summary (artist text, album text, date text, feature text, n integer, {stats})')
+    cursor = conn.execute(f'''
+      select {", ".join(columns)} from acoustic_features
+      where artist is not null and album is not null and date is not null
+      order by artist, album, date
+    ''')
+    carry = pd.DataFrame(columns=columns)
+    while True:
+      rows = cursor.fetchmany(chunk_rows)
+      df = pd.concat([carry, pd.DataFrame(rows, columns=columns)], ignore_index=True)
+      if rows:
+        last = df.iloc[-1]
+        tail = (df['artist'] == last['artist']) & (df['album'] == last['album']) & (df['date'] == last['date'])
+        carry, df = df[tail], df[~tail]
+      if len(df):
+        df[list(FEATURES)] = df[list(FEATURES)].astype(float)
+        summary = summarize_albums(df).astype(object) # plain python values for sqlite
+        conn.executemany(insert, summary.where(summary.notna(), None).itertuples(index=False))
+      if not rows:
+        break
+    conn.execute('create index album_summary_artist on album_summary (artist, feature, date)')
+    mark_built(conn, 'album_summary')
+
+def ensure_album_summary(conn: Connection):
+  if not is_fresh(conn, 'album_summary'):
+    build_album_summary(conn)
+
+if __name__ == '__main__':
+  path = sys.argv[1] if len(sys.argv) > 1 else './billboard-200.db'
+  conn = sqlite3.connect(path)
+  build_decade_trends(conn)
+  build_album_summary(conn)
+  print(f'built decade_trends and album_summary in {path}')
@@ -0,0 +1,329 @@
+# benchmarks for the query layer and page build in utils.py / charts.py
+#
+# $ python bench.py suite --scales 340000 3400000 34000000   # writes bench-results/<time>.json
+# $ python bench.py compare bench-results/a.json bench-results/b.json
+# $ python bench.py dedupe                                   # remove_duplicates vs the old loop
+#
+# the suite runs against synthetic acoustic_features databases (same schema as
+# billboard-200.db), generated once per scale into bench-data/.
+
+import os
+import json
+import time
+import random
+import sqlite3
+import argparse
+import platform
+import subprocess
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import utils
+import storage
+import feature_store
+from db import ConnectionPool
+from ingest import ACOUSTIC_FEATURE_TYPES, ensure_table, rebuild_derived
+from search import ensure_search_index
+from utils import remove_duplicates
+from result_cache import mood_cache
+from charts import scatter_data, bar_data, scatter_chart, comparison_chart, recommendation_chart
+
+DATA_DIR = './bench-data'
+RESULTS_DIR = './bench-results'
+DEFAULT_SCALES = [340000, 3400000, 34000000]
+
+# share of David Bowie rows in the real table (~2k of 340k)
+BOWIE_SHARE = 0.006
+
+def remove_duplicates_loop(df):
+  # the original row-by-row implementation, kept here as the baseline
+  df = df.reset_index(drop=True)
+  song_list = []
+  new_df = None
+
+  i = 0
+  for row in df.values:
+    song_name = row[0]
+
+    if '-' in song_name:
+      song_name = song_name.split(' - ')[0]
+      df.at[i, 'song'] = song_name # rewrite song name
+
+    if song_name not in song_list:
+      song_list.append(song_name)
+
+      if new_df is None:
+        new_df = df[i:i+1]
+      else:
+        new_df = pd.concat([new_df, df[i:i+1]])
+    i += 1
+
+  return new_df
+
+def make_search_results(n, seed=0):
+  # looks like a mood-search result: lots of remasters / live versions of the same songs
+  rng = random.Random(seed)
+  suffixes = ['', '', '', ' - 2015 Remaster', ' - Live', ' - Single Version']
+  songs = [f'Song {rng.randrange(max(n // 3, 1))}{rng.choice(suffixes)}' for _ in range(n)]
+  return pd.DataFrame({
+    'song': songs,
+    'artist': 'David Bowie',
+    'album': [f'Album {rng.randrange(30)}' for _ in range(n)],
+    'date': [f'{rng.randrange(1969, 2019)}-01-01' for _ in range(n)],
+    'energy': [rng.random() for _ in range(n)],
+  })
+
+# synthetic data
+
+def make_synthetic_db(path, n_rows, seed=0, chunk=200000):
+  """Writes an acoustic_features table with n_rows realistic-looking rows."""
+  rng = np.random.default_rng(seed)
+  n_artists = max(300, n_rows // 1000)
+  albums_per_artist = 12
+  album_year = rng.integers(1963, 2019, size=(n_artists, albums_per_artist))
+  album_month = rng.integers(1, 13, size=(n_artists, albums_per_artist))
+  suffixes = np.array(['', '', '', '', ' - Remastered', ' - Live', ' - 2015 Remaster'])
+
+  conn = sqlite3.connect(path)
+  ensure_table(conn, 'acoustic_features', ACOUSTIC_FEATURE_TYPES)
+  columns = ('id', 'song', 'album_id', 'album', 'artist', 'danceability', 'energy', 'instrumentalness', 'valence', 'tempo', 'date')
+  sql = f'insert into acoustic_features ({", ".join(columns)}) values ({", ".join("?" * len(columns))})'
+
+  for start in range(0, n_rows, chunk):
+    size = min(chunk, n_rows - start)
+    artist = rng.integers(1, n_artists, size=size)
+    artist[rng.random(size) < BOWIE_SHARE] = 0 # artist 0 is David Bowie
+    album = rng.integers(0, albums_per_artist, size=size)
+    year = album_year[artist, album]
+    month = album_month[artist, album]
+    song = rng.integers(0, 40, size=size)
+    suffix = suffixes[rng.integers(0, len(suffixes), size=size)]
+    features = np.round(rng.random((size, 4)), 3)
+    tempo = np.round(rng.normal(120, 25, size=size).clip(40, 230), 3)
+
+    artist_names = ['David Bowie' if a == 0 else f'Artist {a}' for a in artist.tolist()]
+    rows = zip(
+      range(start, start + size),
+      [f'Song {a}-{s}{x}' for a, s, x in zip(artist.tolist(), song.tolist(), suffix.tolist())],
+      (artist * albums_per_artist + album).tolist(),
+      [f'{n} album {b}' for n, b in zip(artist_names, album.tolist())],
+      artist_names,
+      *features.T.tolist(),
+      tempo.tolist(),
+      [f'{y}-{m:02d}-01' for y, m in zip(year.tolist(), month.tolist())],
+    )
+    with conn:
+      conn.executemany(sql, rows)
+    print(f'\r  generated {start + size:,} / {n_rows:,} rows', end='', flush=True)
+  print()
+
+  rebuild_derived(conn)
+  conn.close()
+
+def synthetic_db(n_rows):
+  os.makedirs(DATA_DIR, exist_ok=True)
+  path = os.path.join(DATA_DIR, f'acoustic-{n_rows}.db')
+  if not os.path.exists(path):
+    print(f'building {path} ...')
+    make_synthetic_db(path + '.tmp', n_rows)
+    os.replace(path + '.tmp', path)
+  return path
+
+def synthetic_parquet(db_path):
+  root = db_path[:-len('.db')] + '.parquet'
+  if not os.path.isdir(root):
+    storage.export_parquet(db_path, root)
+  return root
+
+# measurement
+
+def measure(func, repeat, setup=None):
+  # setup (untimed) runs once before the timed runs
+  if setup is not None:
+    setup()
+  times = []
+  result = None
+  for _ in range(repeat):
+    start = time.perf_counter()
+    result = func()
+    times.append(time.perf_counter() - start)
+
+  # one extra run under tracemalloc for the allocation peak (numpy / pandas buffers included)
+  tracemalloc.start()
+  func()
+  _, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+
+  times = np.array(times) * 1000
+  stats = {
+    'p50_ms': float(np.percentile(times, 50)),
+    'p95_ms': float(np.percentile(times, 95)),
+    'min_ms': float(times.min()),
+    'peak_mb': peak / 2**20,
+    'runs': repeat,
+  }
+  if isinstance(result, pd.DataFrame):
+    stats['rows'] = len(result)
+  elif isinstance(result, str):
+    stats['bytes'] = len(result)
+  return stats
+
+def suite_cases(pool, parquet_root, feature='energy'):
+  search = dict(decades=(1970, 1979), energy=(0.5, 1.0), valence=(0.5, 1.0), danceability=(0.5, 1.0), sort_by='energy')
+  # where the query functions read from: the in-memory feature store (None), or a storage backend
+  sources = {
+    'feature_store': None,
+    'sqlite': storage.SQLiteStorage(pool),
+    'parquet': storage.ParquetStorage(parquet_root),
+  }
+  cases = {}
+  setups = {} # case -> untimed step run before it (see measure)
+
+  for source in sources:
+    def use(func, source=source):
+      def run():
+        utils.USE_FEATURE_STORE = sources[source] is None
+        storage._storages[pool.cache_key] = sources[source] or sources['sqlite']
+        return func()
+      return run
+
+    def fill_mood_cache():
+      # the mood cache is keyed on the data version, not the source: empty it and let this
+      # source compute the entry, so the timed runs are hits on what it produced
+      mood_cache.clear()
+      utils.get_recommendations(pool, **search)
+
+    cases[f'{source}/get_data'] = use(lambda: utils.get_data(pool))
+    cases[f'{source}/get_data_page'] = use(lambda: utils.get_data_page(pool, 100, artist=None)) # a page deep into the whole table
+    cases[f'{source}/get_bowie_data'] = use(lambda: utils.get_bowie_data(pool, feature))
+    cases[f'{source}/get_feature_avg'] = use(lambda: utils.get_feature_avg(pool, feature))
+    cases[f'{source}/get_all_decade_avg'] = use(lambda: utils.get_all_decade_avg(pool, feature))
+    cases[f'{source}/mood_search'] = use(lambda: utils.search_songs(pool, **search))
+    cases[f'{source}/mood_search_cached'] = use(lambda: utils.get_recommendations(pool, **search)) # repeat query, served by result_cache
+    setups[f'{source}/mood_search_cached'] = use(fill_mood_cache)
+    cases[f'{source}/mood_search_nearest'] = use(lambda: utils.search_songs(pool, mode='nearest', **search))
+
+  # post-processing and chart construction, on the inputs the page would build them from
+  utils.USE_FEATURE_STORE = True
+  storage._storages[pool.cache_key] = sources['sqlite']
+  bowie_data = utils.get_bowie_data(pool, feature)
+  all_decade_avg = utils.get_all_decade_avg(pool, feature)
+  results = utils.search_songs(pool, **{**search, 'decades': (1963, 2019), 'energy': (0.0, 1.0)})
+  top = remove_duplicates(results).head(10)
+
+  cases['remove_duplicates'] = lambda: remove_duplicates(results)
+  cases['chart/scatter'] = lambda: json.dumps(scatter_chart(scatter_data(bowie_data, feature), feature).to_dict())
+  cases['chart/comparison'] = lambda: json.dumps(comparison_chart(bar_data(all_decade_avg), feature).to_dict())
+  cases['chart/recommendations'] = lambda: recommendation_chart(top).to_json()
+  return cases, setups
+
+def run_suite(scales, repeat):
+  import altair as alt
+  alt.data_transformers.disable_max_rows() # measure the full payload, however big
+
+  report = {
+    'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    'commit': _git_commit(),
+    'python': platform.python_version(),
+    'pandas': pd.__version__,
+    'numpy': np.__version__,
+    'repeat': repeat,
+    'scales': {},
+  }
+  for n_rows in scales:
+    path = synthetic_db(n_rows)
+    parquet_root = synthetic_parquet(path)
+    pool = ConnectionPool(path)
+    with pool.writer() as conn: # databases generated before an index was added pick it up here
+      ensure_search_index(conn)
+    results = {}
+
+    # cold load of the shared feature store (paid once per process), from either backend
+    for backend in (storage.ParquetStorage(parquet_root), storage.SQLiteStorage(pool)):
+      feature_store._stores.clear()
+      storage._storages[pool.cache_key] = backend
+      start = time.perf_counter()
+      feature_store.get_feature_store(pool)
+      results[f'feature_store/load_{backend.name}'] = {'p50_ms': (time.perf_counter() - start) * 1000, 'runs': 1}
+
+    cases, setups = suite_cases(pool, parquet_root)
+    for name, func in cases.items():
+      results[name] = measure(func, repeat, setups.get(name))
+      print(f'{n_rows:>10,} {name:<32} p50 {results[name]["p50_ms"]:>10.2f} ms  p95 {results[name]["p95_ms"]:>10.2f} ms  peak {results[name]["peak_mb"]:>8.1f} MB')
+    report['scales'][str(n_rows)] = results
+    pool.close()
+
+  os.makedirs(RESULTS_DIR, exist_ok=True)
+  out = os.path.join(RESULTS_DIR, time.strftime('bench-%Y%m%d-%H%M%S.json'))
+  with open(out, 'w') as f:
+    json.dump(report, f, indent=2)
+  print(f'wrote {out}')
+  return out
+
+def _git_commit():
+  try:
+    return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True, stderr=subprocess.DEVNULL).strip()
+  except Exception:
+    return None
+
+def compare(old_path, new_path):
+  with open(old_path) as f:
+    old = json.load(f)
+  with open(new_path) as f:
+    new = json.load(f)
+  print(f'{old_path} ({old.get("commit")}) -> {new_path} ({new.get("commit")})')
+  for scale, cases in new['scales'].items():
+    for name, stats in cases.items():
+      before = old['scales'].get(scale, {}).get(name)
+      if before is None:
+        continue
+      change = stats['p50_ms'] / before['p50_ms'] if before['p50_ms'] else float('nan')
+      print(f'{int(scale):>10,} {name:<32} {before["p50_ms"]:>10.2f} -> {stats["p50_ms"]:>10.2f} ms  ({change:.2f}x)')
+
+# remove_duplicates micro-benchmark
+
+def best_of(func, repeat):
+  times = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    func()
+    times.append(time.perf_counter() - start)
+  return min(times)
+
+def bench_remove_duplicates(sizes, repeat=3, max_loop_rows=20000):
+  print(f'{"rows":>8} {"loop (s)":>10} {"vectorized (s)":>15} {"speedup":>8}')
+  for n in sizes:
+    df = make_search_results(n)
+    new = best_of(lambda: remove_duplicates(df), repeat)
+    if n <= max_loop_rows: # the loop version is quadratic, don't wait forever on it
+      old = best_of(lambda: remove_duplicates_loop(df.copy()), repeat)
+      print(f'{n:>8} {old:>10.4f} {new:>15.4f} {old / new:>7.1f}x')
+    else:
+      print(f'{n:>8} {"-":>10} {new:>15.4f} {"-":>8}')
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='benchmarks for utils.py')
+  commands = parser.add_subparsers(dest='command', required=True)
+
+  suite = commands.add_parser('suite', help='time the query layer and chart building on synthetic data')
+  suite.add_argument('--scales', type=int, nargs='+', default=DEFAULT_SCALES)
+  suite.add_argument('--repeat', type=int, default=20)
+
+  diff = commands.add_parser('compare', help='compare two suite result files')
+  diff.add_argument('old')
+  diff.add_argument('new')
+
+  dedupe = commands.add_parser('dedupe', help='remove_duplicates vs the old row-by-row loop')
+  dedupe.add_argument('--sizes', type=int, nargs='+', default=[10, 1000, 10000, 50000])
+  dedupe.add_argument('--repeat', type=int, default=3)
+  dedupe.add_argument('--max-loop-rows', type=int, default=20000)
+
+  args = parser.parse_args()
+  if args.command == 'suite':
+    run_suite(args.scales, args.repeat)
+  elif args.command == 'compare':
+    compare(args.old, args.new)
+  else:
+    bench_remove_duplicates(args.sizes, args.repeat, args.max_loop_rows)
@@ -0,0 +1,162 @@
+# chart builders for the dashboard, shared by streamlit_app.py and the benchmarks
+#
+# every row handed to an altair chart is embedded in the vega-lite spec sent to the
+# browser on each rerun, so chart inputs first go through a reduction step
+# (scatter_data / bar_data) that keeps the payload bounded by CHART_ROW_BUDGET
+# instead of growing with the artist / dataset.
+#
+# altair and plotly are imported inside the builders, so loading this module (and
+# the app's first paint) doesn't pay for them before a chart is actually drawn.
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from db import FEATURES
+
+# max rows embedded in one chart (altair itself refuses more than 5000 by default)
+CHART_ROW_BUDGET = int(os.environ.get('CHART_ROW_BUDGET', 5000))
+
+# features the scatter chart can put on y (valence is its color, tempo its size);
+# the app's "which acoustic feature" picker offers these
+CHART_FEATURES = tuple(name for name in FEATURES if name not in ('valence', 'tempo'))
+
+#color palette for scatter chart
+VALENCE_COLORS = ['#D64550', '#EE8189', '#FC8B4A','#F7B801','#B9F18C','#71DA1B','#439A86','#00BECC','#7678ED','#3D348B']
+
+def stratified_sample(df, by, budget=CHART_ROW_BUDGET, seed=0):
+  """
+  Keeps about `budget` rows of df, the same share from every `by` group (at least one
+  each, so no group disappears). Rows are kept whole, so tooltips still show real
+  songs. The seed is fixed so reruns draw the same points.
+  """
+  if len(df) <= budget:
+    return df
+  share = budget / len(df)
+  # group on factorize codes: missing values (no album) become a group of their own (-1)
+  # instead of being dropped by groupby
+  groups = pd.Series(pd.factorize(df[by])[0], index=df.index)
+  sizes = groups.map(groups.value_counts())
+  quota = np.maximum(1, np.floor(sizes * share))
+  draw = pd.Series(np.random.default_rng(seed).random(len(df)), index=df.index)
+  rank = draw.groupby(groups).rank(method='first')
+  return df[rank <= quota]
+
+def scatter_data(data, option, budget=CHART_ROW_BUDGET):
+  # only the encoded columns (+ id for the "more like this" link), sampled per album above the budget
+  data = data[['album', 'song', 'date', option, 'valence', 'tempo', 'id']]
+  return stratified_sample(data, 'album', budget)
+
+def bar_data(all_decade_avg):
+  # one row per album for the bar charts: get_all_decade_avg has a row per album
+  # *release date*, which vega-lite would stack into one taller bar
+  df = all_decade_avg.sort_values('date', kind='mergesort')
+  df = df.groupby('album', sort=False).agg(
+    date=('date', 'first'),
+    avg_feature=('avg_feature', 'mean'),
+    trend_feature=('trend_feature', 'first'), # decade of the first release
+  ).reset_index()
+  df['avg_feature'] = df['avg_feature'].round(2)
+  return df
+
+def scatter_chart(data, option):
+  import altair as alt
+  # songs by album, y = selected feature, colored by valence, sized by tempo
+  select_scatter = alt.selection_multi(fields=['valence'], bind='legend')
+
+  return alt.Chart(data).mark_circle().transform_calculate(
+    url="'?similar=' + datum.id" # click a song for "more like this" (sidebar)
+  ).encode(
+  alt.X('album',scale=alt.Scale(zero=True), sort={"field": "date", "order": "ascending"},title="Albums order by Issued Date"),
+  alt.Y(option,scale=alt.Scale(zero=True), title=option),
+  alt.Color('valence:O',
+    sort='descending',scale=alt.Scale(range=VALENCE_COLORS)),
+    tooltip=['album','song','date', option, 'valence', 'tempo'],
+    size=alt.Size('tempo',
+    scale=alt.Scale(domain=[0,100], range=[1,200]),
+    legend=alt.Legend(values=[50,100,150,200])),
+    opacity=alt.condition(select_scatter, alt.value(1), alt.value(0.1)),
+    href='url:N'
+  ).properties(
+    width=900,
+    height=900
+  ).add_selection(
+    select_scatter
+  )
+
+def album_bar_chart(all_decade_avg, option):
+  import altair as alt
+  #chart-bar
+  selector = alt.selection_single(empty='all', fields=['album'])
+
+  # TODO: fix chart sizing
+  return alt.Chart(all_decade_avg).mark_bar(color='#1FC3AA', opacity=0.5, thickness=10).encode(
+    alt.X('album',
+      sort={"field": "date", "order": "ascending"},
+      title="(B)Albums order by Issued Date"),
+    alt.Y('avg_feature',
+      scale=alt.Scale(zero=False),
+      title='(B)Average_'+ option +'_by_Albums'),
+      tooltip=['album', 'date', 'avg_feature'],
+      color=alt.condition(selector, 'album:O', alt.value('lightgray'), legend=None),
+  ).properties(
+    width=850,
+    height=600
+  ).add_selection(selector)
+
+def decade_bar_chart(all_decade_avg, option):
+  import altair as alt
+  #chart-decade
+  return alt.Chart(all_decade_avg).mark_bar(color='#8624F5', opacity=0.5, thickness=10).encode(
+    alt.X('album',
+      sort={"field": "date", "order": "ascending"},
+      title="(V)The correspondent decade of albums Issued Date"),
+    alt.Y('trend_feature',
+      scale=alt.Scale(zero=False),
+      title='(V)Average_'+ option +'_by_Decade')
+  ).properties(
+    width=850,
+    height=600
+  )
+
+def comparison_chart(all_decade_avg, option):
+  # album averages layered over the decade averages, with the album numbers on top
+  bar_album = album_bar_chart(all_decade_avg, option)
+  bar_decade = decade_bar_chart(all_decade_avg, option)
+
+  #chart-decade-the numbers
+  text_decade = bar_decade.mark_text(align='center', color='white',dy=80).encode(
+    text='avg_feature:N'
+  )
+  return bar_decade+bar_album+text_decade
+
+def decade_box_chart(boxes, albums, option):
+  import altair as alt
+  # every song of each decade as a box plot (5th / 25th / median / 75th / 95th
+  # percentile, from get_decade_distribution) with the albums' averages on top
+  x = alt.X('decade:O', title='Decade')
+  tooltip = ['decade', 'n', 'p05', 'q25', 'median', 'q75', 'p95']
+  whiskers = alt.Chart(boxes).mark_rule(color='#1FC3AA').encode(x, alt.Y('p05', title=option), alt.Y2('p95'), tooltip=tooltip)
+  box = alt.Chart(boxes).mark_bar(color='#1FC3AA', opacity=0.4, size=40).encode(x, alt.Y('q25'), alt.Y2('q75'), tooltip=tooltip)
+  median = alt.Chart(boxes).mark_tick(color='white', size=40, thickness=2).encode(x, alt.Y('median'))
+  points = alt.Chart(albums).mark_circle(size=80).encode(
+    x,
+    alt.Y('avg_feature'),
+    color=alt.Color('album:N', legend=None),
+    tooltip=['album', 'date', 'avg_feature', alt.Tooltip('decade_percentile', title='percentile in its decade')],
+  )
+  return (whiskers + box + median + points).properties(
+    width=850,
+    height=500
+  )
+
+def recommendation_chart(df):
+  import plotly.express as px
+  return px.bar(
+    df,
+    x='song',
+    y=['energy','valence','danceability'],
+    barmode='group',
+    height=500
+  )
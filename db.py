@@ -0,0 +1,165 @@
+# small query layer over billboard-200.db
+#
+# sessions borrow read-only connections from a shared pool instead of all going
+# through one connection, and every query is a fixed sql string with bound
+# parameters so sqlite's per-connection statement cache can reuse the plan.
+# identifiers (feature / sort columns) can't be bound, so they are whitelisted.
+
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+import pandas as pd
+
+FEATURES = ('danceability', 'energy', 'instrumentalness', 'valence', 'tempo')
+SORT_KEYS = FEATURES + ('date',)
+
+def check_feature(name):
+  if name not in FEATURES:
+    raise ValueError(f'unknown feature: {name!r}')
+  return name
+
+def check_sort_key(name):
+  if name not in SORT_KEYS:
+    raise ValueError(f'unknown sort key: {name!r}')
+  return name
+
+def has_table(pool, name):
+  rows = pool.execute("select 1 from sqlite_master where type in ('table', 'view') and name = ?", (name,))
+  return len(rows) > 0
+
+def read_only_uri(path):
+  # as_uri() needs an absolute path
+  return Path(path).resolve().as_uri() + '?mode=ro'
+
+def data_version(path):
+  # token that changes when a writer finishes (it bumps pragma user_version once, at the
+  # end, see bump_data_version) or the file is replaced by a new one (its inode changes).
+  # commits in between don't change it, so a long ingest isn't picked up batch by batch
+  try:
+    inode = os.stat(path).st_ino
+  except FileNotFoundError:
+    return ''
+  conn = sqlite3.connect(read_only_uri(path), uri=True)
+  try:
+    user_version = conn.execute('pragma user_version').fetchone()[0]
+  finally:
+    conn.close()
+  return f'{inode}.{user_version}'
+
+def bump_data_version(conn):
+  # called by writers (ingest.py) once all their changes are committed, so readers see one new version per write
+  version = conn.execute('pragma user_version').fetchone()[0] + 1
+  conn.execute(f'pragma user_version = {version}')
+  return version
+
+class ConnectionPool:
+  def __init__(self, path, size=int(os.environ.get('DB_POOL_SIZE', 8)), cached_statements=256):
+    self.path = str(Path(path).resolve())
+    self.size = size
+    self.cached_statements = cached_statements
+    self.version = data_version(self.path)
+    self._idle = queue.LifoQueue()
+    self._opened = 0
+    self._generation = 0 # bumped by refresh(), connections of older generations get reopened
+    self._generations = {} # connection -> generation it was opened in
+    self._lock = threading.Lock()
+
+  @property
+  def cache_key(self):
+    # what every cached result computed from this database is keyed on
+    return (self.path, self.version)
+
+  def refresh(self):
+    """
+    Checks whether the database changed since the last call (an ingest finished, or a
+    new copy was moved over the file). If it did, connections are reopened so every query from now
+    on reads the new data, and cache_key changes. Returns True when it changed.
+    """
+    version = data_version(self.path)
+    if version == self.version:
+      return False
+    with self._lock:
+      if version == self.version:
+        return False
+      self.version = version
+      self._generation += 1
+    return True
+
+  def _open(self):
+    conn = sqlite3.connect(
+      read_only_uri(self.path),
+      uri=True,
+      check_same_thread=False, # a connection moves between threads, but only one uses it at a time
+      cached_statements=self.cached_statements,
+    )
+    conn.execute('pragma query_only = on')
+    self._generations[conn] = self._generation
+    return conn
+
+  def _current(self, conn):
+    # a connection opened before the file changed is reopened (a replaced file would
+    # otherwise stay open under its old inode, and its page cache may be stale)
+    if self._generations.get(conn) == self._generation:
+      return conn
+    self._generations.pop(conn, None)
+    conn.close()
+    try:
+      return self._open()
+    except Exception:
+      with self._lock:
+        self._opened -= 1
+      raise
+
+  def _checkout(self):
+    try:
+      return self._current(self._idle.get_nowait())
+    except queue.Empty:
+      pass
+    with self._lock:
+      if self._opened < self.size:
+        self._opened += 1
+        try:
+          return self._open()
+        except Exception:
+          self._opened -= 1
+          raise
+    return self._current(self._idle.get()) # pool exhausted, wait for someone to give one back
+
+  @contextmanager
+  def connection(self):
+    conn = self._checkout()
+    try:
+      yield conn
+    finally:
+      self._idle.put(conn)
+
+  def execute(self, sql, params=()):
+    with self.connection() as conn:
+      return conn.execute(sql, params).fetchall()
+
+  def read_sql(self, sql, params=()):
+    with self.connection() as conn:
+      return pd.read_sql(sql, con=conn, params=params)
+
+  @contextmanager
+  def writer(self):
+    # separate read-write connection for build steps (aggregates, indexes, ...)
+    conn = sqlite3.connect(self.path)
+    try:
+      yield conn
+    finally:
+      conn.close()
+
+  def close(self):
+    while True:
+      try:
+        conn = self._idle.get_nowait()
+      except queue.Empty:
+        break
+      self._generations.pop(conn, None)
+      conn.close()
+    self._opened = 0
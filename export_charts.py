@@ -0,0 +1,146 @@
+# pre-render the dashboard's charts to static files, without a browser session
+#
+# $ python export_charts.py billboard-200.db                       # david bowie -> chart-export/
+# $ python export_charts.py billboard-200.db --artist "Prince" "Madonna"
+# $ python export_charts.py billboard-200.db --all-artists --min-tracks 50 --workers 8
+#
+# for every (artist, feature) it writes the scatter chart, the album bar chart and the
+# album vs decade comparison as vega-lite json + standalone html, and per artist the
+# plotly recommendation chart (default slider settings) as plotly json:
+#
+#   chart-export/<artist>/<feature>-scatter.vl.json / .html
+#   chart-export/<artist>/<feature>-albums.vl.json / .html
+#   chart-export/<artist>/<feature>-comparison.vl.json / .html
+#   chart-export/<artist>/recommendations.plotly.json
+#   chart-export/index.json
+#
+# the work is spread over a process pool; every worker opens its own read-only
+# connections to the same database file.
+
+import os
+import re
+import sys
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from charts import CHART_FEATURES # the features offered by the selectbox in streamlit_app.main
+
+# the search section's default slider settings
+RECOMMENDATION_SEARCH = dict(decades=(1970, 1979), energy=(0.5, 1.0), valence=(0.5, 1.0), danceability=(0.5, 1.0), sort_by='energy')
+
+_pool = None # per worker process
+
+def _init_worker(db_path, use_feature_store):
+  global _pool
+  import utils
+  from db import ConnectionPool
+  # a worker builds one chart at a time, it doesn't need more than one connection
+  _pool = ConnectionPool(db_path, size=1)
+  utils.USE_FEATURE_STORE = use_feature_store
+  if use_feature_store:
+    from feature_store import get_feature_store
+    get_feature_store(_pool) # load it up front, the queries only use an already loaded store
+
+def slugify(name):
+  return re.sub(r'[^a-z0-9]+', '-', name.lower()).strip('-') or 'unknown'
+
+def _write_altair(chart, path):
+  # serialize (and schema-validate) the chart once, then write both files from the same spec
+  import altair as alt
+  from altair.utils.html import spec_to_html
+
+  spec = chart.to_dict()
+  with open(path + '.vl.json', 'w') as f:
+    json.dump(spec, f)
+  html = spec_to_html( # standalone page that loads vega from a cdn
+    spec, mode='vega-lite',
+    vega_version=alt.VEGA_VERSION, vegalite_version=alt.VEGALITE_VERSION, vegaembed_version=alt.VEGAEMBED_VERSION,
+  )
+  with open(path + '.html', 'w') as f:
+    f.write(html)
+  return [path + '.vl.json', path + '.html']
+
+def export_artist(artist, features, out_dir):
+  # runs in a worker: every chart of one artist
+  import utils
+  from charts import scatter_data, bar_data, scatter_chart, album_bar_chart, comparison_chart, recommendation_chart
+
+  start = time.perf_counter()
+  folder = os.path.join(out_dir, slugify(artist))
+  os.makedirs(folder, exist_ok=True)
+  files = []
+
+  for feature in features:
+    songs = utils.get_bowie_data(_pool, feature, artist)
+    albums = bar_data(utils.get_all_decade_avg(_pool, feature, artist))
+    files += _write_altair(scatter_chart(scatter_data(songs, feature), feature), os.path.join(folder, f'{feature}-scatter'))
+    files += _write_altair(album_bar_chart(albums, feature), os.path.join(folder, f'{feature}-albums'))
+    files += _write_altair(comparison_chart(albums, feature), os.path.join(folder, f'{feature}-comparison'))
+
+  warnings = []
+  results = utils.search_songs(_pool, artist=artist, **RECOMMENDATION_SEARCH)
+  if len(results.index):
+    path = os.path.join(folder, 'recommendations.plotly.json')
+    with open(path, 'w') as f:
+      f.write(recommendation_chart(utils.remove_duplicates(results).head(10)).to_json())
+    files.append(path)
+  else:
+    warnings.append('no songs for the default search settings, recommendations.plotly.json not written')
+
+  return {'artist': artist, 'files': [os.path.relpath(path, out_dir) for path in files], 'warnings': warnings, 'seconds': time.perf_counter() - start}
+
+def list_artists(db_path, min_tracks):
+  from db import ConnectionPool, has_table
+  pool = ConnectionPool(db_path, size=1)
+  if has_table(pool, 'artists'): # built by search.py
+    rows = pool.execute('select name from artists where n_tracks >= ? order by n_tracks desc', (min_tracks,))
+  else:
+    rows = pool.execute('select artist from acoustic_features where artist is not null group by artist having count(*) >= ? order by count(*) desc', (min_tracks,))
+  pool.close()
+  return [row[0] for row in rows]
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='export the dashboard charts as vega-lite / plotly files')
+  parser.add_argument('db', help='sqlite database (opened read-only)')
+  parser.add_argument('--out', default='chart-export', help='output directory')
+  parser.add_argument('--artist', nargs='+', default=['David Bowie'])
+  parser.add_argument('--all-artists', action='store_true', help='every artist with at least --min-tracks tracks')
+  parser.add_argument('--min-tracks', type=int, default=20)
+  parser.add_argument('--features', nargs='+', default=list(CHART_FEATURES), choices=CHART_FEATURES)
+  parser.add_argument('--workers', type=int, default=os.cpu_count())
+  parser.add_argument('--feature-store', action='store_true', help='answer queries from the in-memory feature store (one copy of the table per worker)')
+  args = parser.parse_args(argv)
+
+  if not os.path.exists(args.db):
+    parser.error(f'{args.db}: no such file')
+  db_path = os.path.abspath(args.db)
+  artists = list_artists(db_path, args.min_tracks) if args.all_artists else args.artist
+  os.makedirs(args.out, exist_ok=True)
+
+  start = time.perf_counter()
+  exported = []
+  failed = 0
+  with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker, initargs=(db_path, args.feature_store)) as executor:
+    futures = {executor.submit(export_artist, artist, args.features, args.out): artist for artist in artists}
+    for future in as_completed(futures):
+      try:
+        exported.append(future.result())
+        for warning in exported[-1]['warnings']:
+          print(f'\n{futures[future]}: warning: {warning}', file=sys.stderr)
+      except Exception as e: # one broken artist shouldn't stop the export
+        failed += 1
+        print(f'\n{futures[future]}: {e}', file=sys.stderr)
+      print(f'\r{len(exported) + failed:,} / {len(artists):,} artists', end='', flush=True)
+  print()
+
+  exported.sort(key=lambda item: item['artist'])
+  with open(os.path.join(args.out, 'index.json'), 'w') as f:
+    json.dump({'db': db_path, 'features': args.features, 'artists': exported}, f, indent=2)
+  n_files = sum(len(item['files']) for item in exported)
+  print(f'wrote {n_files:,} files for {len(exported):,} artists to {args.out} in {time.perf_counter() - start:.1f}s ({failed} failed)')
+  return 1 if failed else 0
+
+if __name__ == '__main__':
+  sys.exit(main())
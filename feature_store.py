@@ -0,0 +1,190 @@
+# process-wide, read-only, columnar copy of acoustic_features
+#
+# the table is loaded once per process into typed numpy columns (float32 features,
+# dictionary-encoded strings, datetime64 dates) and every session answers its
+# queries as vectorized masks over those arrays instead of going back to sqlite.
+
+import threading
+
+import numpy as np
+import pandas as pd
+
+from db import FEATURES
+from paging import PAGE_SIZE, page_positions, cursor
+
+CATEGORY_COLUMNS = ('song', 'artist', 'album')
+
+def _read_only(arr):
+  arr.setflags(write=False)
+  return arr
+
+def round_significant(values, digits=6):
+  # float64 values rounded to `digits` significant digits (float32 round-trips 6), so
+  # small values keep theirs: 3.47e-06 stays 3.47e-06 where 7 decimals gave 3.5e-06
+  with np.errstate(divide='ignore', invalid='ignore'):
+    magnitude = np.floor(np.log10(np.abs(values)))
+  scale = 10.0 ** np.where(np.isfinite(magnitude), digits - 1 - magnitude, 0)
+  return np.round(values * scale) / scale
+
+class YearSlicer:
+  """
+  A frame kept sorted by `column` (a datetime) with a precomputed year array, so a
+  [start, end] year range is two binary searches and a zero-copy row slice instead
+  of boolean masks over the whole frame. Rows without a date sort first (year -1).
+  """
+  def __init__(self, df, column='date'):
+    self.frame = df.sort_values(column, kind='mergesort', na_position='first').reset_index(drop=True)
+    self.years = _read_only(self.frame[column].dt.year.fillna(-1).to_numpy(dtype=np.int16))
+
+  def bounds(self, start, end):
+    lo, hi = np.searchsorted(self.years, [start, end + 1])
+    return int(lo), int(hi)
+
+  def slice(self, start, end):
+    lo, hi = self.bounds(start, end)
+    return self.frame.iloc[lo:hi]
+
+class FeatureStore:
+  def __init__(self, df):
+    # keep rows in date order (undated rows first) so year ranges are contiguous
+    df = df.assign(date=pd.to_datetime(df['date'], errors='coerce'))
+    df = df.sort_values(['date', 'id'], kind='mergesort', na_position='first').reset_index(drop=True)
+    self.n = len(df)
+
+    self.id = _read_only(df['id'].to_numpy(dtype=np.int64))
+
+    # strings are stored as int32 codes into a shared array of unique values
+    self.codes = {}
+    self.categories = {}
+    self.lookup = {} # value -> code, for O(1) equality filters
+    for name in CATEGORY_COLUMNS:
+      codes, uniques = pd.factorize(df[name].fillna(''))
+      self.codes[name] = _read_only(codes.astype(np.int32))
+      self.categories[name] = _read_only(np.asarray(uniques, dtype=object))
+      if name != 'song': # ~all songs are unique, not worth a dict
+        self.lookup[name] = {value: code for code, value in enumerate(uniques)}
+
+    self.features = {}
+    for name in FEATURES:
+      self.features[name] = _read_only(df[name].to_numpy(dtype=np.float32, na_value=np.nan))
+
+    self.date = _read_only(df['date'].to_numpy(dtype='datetime64[ns]'))
+    self.year = _read_only(df['date'].dt.year.fillna(-1).to_numpy(dtype=np.int16))
+
+  @classmethod
+  def from_pool(cls, pool):
+    # read through the storage backend: a parquet export loads much faster than read_sql
+    from storage import get_storage
+    return cls(get_storage(pool).tracks(('id', 'date') + CATEGORY_COLUMNS + FEATURES))
+
+  # masks
+
+  def all(self):
+    return np.ones(self.n, dtype=bool)
+
+  def equals(self, name, value):
+    if name in self.lookup:
+      code = self.lookup[name].get(value)
+    else:
+      matches = np.flatnonzero(self.categories[name] == value)
+      code = matches[0] if len(matches) else None
+    if code is None:
+      return np.zeros(self.n, dtype=bool)
+    return self.codes[name] == code
+
+  def contains(self, name, substring):
+    # equivalent of `name LIKE '%substring%'`, evaluated once per unique value
+    substring = substring.lower()
+    hits = np.array([substring in value.lower() for value in self.categories[name]], dtype=bool)
+    return hits[self.codes[name]]
+
+  def between(self, name, low, high):
+    # compare in float32 too, otherwise 0.7 (float64) would exclude a stored 0.7 (float32)
+    values = self.features[name]
+    return (values >= np.float32(low)) & (values <= np.float32(high))
+
+  def year_range(self, start, end):
+    # rows are in date order, so a year range is one slice found by binary search
+    lo, hi = np.searchsorted(self.year, [start, end + 1])
+    return slice(int(lo), int(hi))
+
+  def years(self, start, end):
+    mask = np.zeros(self.n, dtype=bool)
+    mask[self.year_range(start, end)] = True
+    return mask
+
+  # materialization
+
+  def column(self, name, mask=None):
+    idx = slice(None) if mask is None else mask
+    if name in self.codes:
+      return self.categories[name][self.codes[name][idx]]
+    if name in self.features:
+      # float32 -> float64 picks up noise in the last digits (0.7 -> 0.699999988),
+      # the source values only have a few significant digits so round it back off
+      return round_significant(self.features[name][idx].astype(np.float64))
+    if name == 'date':
+      return self.date[idx]
+    if name == 'year':
+      return self.year[idx]
+    if name == 'id':
+      return self.id[idx]
+    raise KeyError(name)
+
+  def select(self, columns, mask=None):
+    return pd.DataFrame({name: self.column(name, mask) for name in columns})
+
+  # paging, same contract as Storage.page (see paging.py)
+
+  def page(self, columns, artist=None, sort_by='date', descending=False, after=None, limit=PAGE_SIZE):
+    rows = np.flatnonzero(self.equals('artist', artist)) if artist is not None else np.arange(self.n)
+    keys = self.date if sort_by == 'date' else self.features[sort_by]
+    positions = rows[page_positions(keys[rows], self.id[rows], descending, after, limit)]
+    return self.select(columns, positions), [cursor(key, id) for key, id in zip(keys[positions], self.id[positions])]
+
+  def count(self, artist=None):
+    return self.n if artist is None else int(self.equals('artist', artist).sum())
+
+_stores = {}
+_loading = {} # path -> background loader thread, one per database at a time
+_lock = threading.Lock()
+_loading_lock = threading.Lock()
+
+def _load(pool):
+  key = pool.cache_key
+  with _lock:
+    store = _stores.get(key)
+    if store is None: # only the first session pays for the load
+      store = FeatureStore.from_pool(pool)
+      for old in [old for old in _stores if old[0] == pool.path]: # earlier versions of the file
+        del _stores[old]
+      _stores[key] = store
+  return store
+
+def _load_in_background(pool):
+  try:
+    _load(pool)
+  except Exception as e: # sessions keep answering from sqlite, a later rerun tries again
+    print(e)
+  finally:
+    with _loading_lock:
+      _loading.pop(pool.path, None)
+
+def get_feature_store(pool, wait=True):
+  """
+  The process-wide store for pool's database (reloaded when its data version
+  changes, see ConnectionPool.refresh). With wait=False a store that isn't
+  loaded yet is loaded on a background thread and None is returned until it's ready,
+  so a cold start doesn't hold up the first render. Only one background load per
+  database runs at a time; a version that changes during it is loaded on a later call.
+  """
+  store = _stores.get(pool.cache_key)
+  if store is not None:
+    return store
+  if not wait:
+    with _loading_lock:
+      if pool.path not in _loading:
+        _loading[pool.path] = threading.Thread(target=_load_in_background, args=(pool,), name='feature-store', daemon=True)
+        _loading[pool.path].start()
+    return None
+  return _load(pool)
@@ -0,0 +1,167 @@
+# build / extend billboard-200.db from raw csv or json-lines files
+#
+# $ python ingest.py billboard-200.db --features acoustic_features.csv --albums albums.jsonl
+#
+# input is streamed in fixed-size batches (never loaded into pandas), each batch is
+# upserted on `id` with executemany inside its own transaction, secondary indexes
+# are dropped for the load and created once at the end, and then every derived
+# table (decade trends, album summary, search indexes) is rebuilt. the feature
+# histograms (sketches.py) are instead updated batch by batch as rows come in.
+
+import csv
+import sys
+import gzip
+import json
+import time
+import itertools
+import sqlite3
+import argparse
+from sqlite3 import Connection
+
+from aggregates import build_decade_trends, build_album_summary, is_fresh, mark_built, publish
+from sketches import apply_delta, ensure_histograms
+from search import build_search_index
+
+# column -> type; the types matter, csv values arrive as strings and only a typed
+# column converts '0.5' to a real
+ACOUSTIC_FEATURE_TYPES = {
+  'id': 'integer', 'song': 'text', 'album_id': 'integer', 'album': 'text', 'artist': 'text',
+  'acousticness': 'real', 'danceability': 'real', 'duration_ms': 'real', 'energy': 'real',
+  'instrumentalness': 'real', 'key': 'real', 'liveness': 'real', 'loudness': 'real', 'mode': 'real',
+  'speechiness': 'real', 'tempo': 'real', 'time_signature': 'real', 'valence': 'real', 'date': 'text',
+}
+ALBUM_TYPES = {
+  'id': 'integer', 'date': 'text', 'artist': 'text', 'album': 'text', 'rank': 'integer',
+  'length': 'integer', 'track_length': 'real',
+}
+
+# secondary indexes on acoustic_features that are cheaper to rebuild than to maintain row by row
+BULK_INDEXES = ('acoustic_features_artist_date', 'acoustic_features_artist_date_id', 'acoustic_features_date_id', 'acoustic_features_album')
+
+def _open(path):
+  if path.endswith('.gz'):
+    return gzip.open(path, 'rt', newline='', encoding='utf-8')
+  return open(path, newline='', encoding='utf-8')
+
+def read_rows(path):
+  # yields one dict per input row, csv or json lines (optionally gzipped)
+  with _open(path) as f:
+    name = path[:-3] if path.endswith('.gz') else path
+    if name.endswith(('.jsonl', '.json', '.ndjson')):
+      for line in f:
+        if line.strip():
+          yield json.loads(line)
+    else:
+      yield from csv.DictReader(f)
+
+def batches(rows, columns, size):
+  batch = []
+  for row in rows:
+    if row.get('id') in (None, ''):
+      continue # can't upsert without a track id
+    # empty csv cells become NULL, sqlite's column affinity takes care of numbers
+    batch.append(tuple(None if row.get(name) == '' else row.get(name) for name in columns))
+    if len(batch) == size:
+      yield batch
+      batch = []
+  if batch:
+    yield batch
+
+def ensure_table(conn: Connection, table, columns):
+  definitions = ', '.join(f'{name} {kind}' for name, kind in columns.items())
+  conn.execute(f'create table if not exists {table} ({definitions})')
+  existing = [row[1] for row in conn.execute(f'pragma table_info({table})')]
+  for name, kind in columns.items():
+    if name not in existing:
+      conn.execute(f'alter table {table} add column {name} {kind}')
+  # upserts need a unique index on the conflict target
+  conn.execute(f'create unique index if not exists {table}_id on {table} (id)')
+
+def upsert_sql(table, columns):
+  updates = ', '.join(f'{name} = excluded.{name}' for name in columns if name != 'id')
+  return f'''
+    insert into {table} ({", ".join(columns)}) values ({", ".join("?" * len(columns))})
+    on conflict (id) do update set {updates}
+  '''
+
+def load(conn: Connection, path, table, columns, batch_size=10000, track_histograms=False):
+  ensure_table(conn, table, columns)
+  rows = read_rows(path)
+  first = next(rows, None)
+  if first is None:
+    return 0
+
+  # only write the columns the input actually has, so an upsert doesn't null out the rest
+  columns = tuple(name for name in columns if name in first)
+  if 'id' not in columns:
+    raise ValueError(f'{path}: input has no id column')
+  sql = upsert_sql(table, columns)
+  id_index = columns.index('id')
+  total = 0
+  start = time.perf_counter()
+  for batch in batches(itertools.chain([first], rows), columns, batch_size):
+    with conn: # one transaction per batch keeps the journal (and memory) bounded
+      if track_histograms: # keep the feature histograms in step: out with the replaced rows, in with the new
+        ids = [row[id_index] for row in batch]
+        apply_delta(conn, ids, -1)
+      conn.executemany(sql, batch)
+      if track_histograms:
+        apply_delta(conn, ids, 1)
+    total += len(batch)
+    rate = total / (time.perf_counter() - start)
+    print(f'\r{table}: {total:,} rows ({rate:,.0f} rows/s)', end='', flush=True)
+  print()
+  return total
+
+def drop_bulk_indexes(conn: Connection):
+  with conn:
+    for name in BULK_INDEXES:
+      conn.execute(f'drop index if exists {name}')
+
+def rebuild_derived(conn: Connection):
+  # everything computed from acoustic_features; also recreates BULK_INDEXES.
+  # the feature histograms are updated batch by batch during the load instead,
+  # and only rebuilt here if they weren't up to date before it
+  build_search_index(conn)
+  build_decade_trends(conn)
+  build_album_summary(conn)
+  ensure_histograms(conn)
+  return ('search_index', 'decade_trends', 'album_summary', 'feature_histograms')
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='stream csv / jsonl files into billboard-200.db')
+  parser.add_argument('db', help='sqlite database to create or extend')
+  parser.add_argument('--features', nargs='*', default=[], help='acoustic feature rows (.csv, .jsonl, optionally .gz)')
+  parser.add_argument('--albums', nargs='*', default=[], help='album chart rows (.csv, .jsonl, optionally .gz)')
+  parser.add_argument('--batch-size', type=int, default=10000)
+  parser.add_argument('--keep-indexes', action='store_true', help="don't drop secondary indexes during the load (faster for small updates)")
+  args = parser.parse_args(argv)
+
+  conn = sqlite3.connect(args.db)
+  conn.execute('pragma synchronous = normal')
+  conn.execute('pragma cache_size = -200000') # ~200 MB page cache for the bulk load
+
+  if args.features and not args.keep_indexes:
+    drop_bulk_indexes(conn)
+
+  track_histograms = bool(args.features) and is_fresh(conn, 'feature_histograms')
+  for path in args.features:
+    load(conn, path, 'acoustic_features', ACOUSTIC_FEATURE_TYPES, args.batch_size, track_histograms)
+  if track_histograms:
+    with conn:
+      mark_built(conn, 'feature_histograms')
+  for path in args.albums:
+    load(conn, path, 'albums', ALBUM_TYPES, args.batch_size)
+
+  rebuilt = None # only albums changed, every derived table stays fresh
+  if args.features:
+    print('rebuilding indexes and derived tables ...')
+    rebuilt = rebuild_derived(conn)
+  # one new data version for the whole ingest: running apps reload once, now, instead of
+  # after every batch (see db.data_version), with the rebuilt tables fresh under it
+  if args.features or args.albums:
+    publish(conn, rebuilt)
+  conn.close()
+
+if __name__ == '__main__':
+  sys.exit(main())
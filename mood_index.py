@@ -0,0 +1,173 @@
+# spatial index over the (energy, valence, danceability[, tempo]) "mood" of every track
+#
+# a kd-tree over numpy arrays: answers "k closest songs to this target mood" and
+# box (range) queries over the whole corpus without scanning every row.
+
+import heapq
+import threading
+import weakref
+
+import numpy as np
+
+MOOD_FEATURES = ('energy', 'valence', 'danceability')
+
+# fixed scales so every dimension ends up in 0-1 (spotify defines these ranges)
+FEATURE_RANGES = {
+  'energy': (0.0, 1.0),
+  'valence': (0.0, 1.0),
+  'danceability': (0.0, 1.0),
+  'instrumentalness': (0.0, 1.0),
+  'tempo': (0.0, 250.0),
+}
+
+def normalize(name, values):
+  low, high = FEATURE_RANGES[name]
+  return (np.asarray(values, dtype=np.float64) - low) / (high - low)
+
+class KDTree:
+  def __init__(self, points, leaf_size=32):
+    self.points = np.ascontiguousarray(points, dtype=np.float32)
+    self.leaf_size = leaf_size
+    self.idx = np.arange(len(self.points))
+
+    # flat node arrays, filled in by _build
+    self.start, self.end = [], []
+    self.left, self.right = [], []
+    self.box_min, self.box_max = [], []
+    if len(self.points):
+      self._build(0, len(self.points))
+    self.box_min = np.array(self.box_min, dtype=np.float32)
+    self.box_max = np.array(self.box_max, dtype=np.float32)
+
+  def _build(self, start, end):
+    node = len(self.start)
+    pts = self.points[self.idx[start:end]]
+    self.start.append(start)
+    self.end.append(end)
+    self.left.append(-1)
+    self.right.append(-1)
+    self.box_min.append(pts.min(axis=0))
+    self.box_max.append(pts.max(axis=0))
+
+    if end - start > self.leaf_size:
+      # split the widest dimension at the median
+      dim = int(np.argmax(self.box_max[node] - self.box_min[node]))
+      mid = (end - start) // 2
+      order = np.argpartition(pts[:, dim], mid)
+      self.idx[start:end] = self.idx[start:end][order]
+      self.left[node] = self._build(start, start + mid)
+      self.right[node] = self._build(start + mid, end)
+    return node
+
+  def _box_distance(self, node, target):
+    below = np.maximum(self.box_min[node] - target, 0)
+    above = np.maximum(target - self.box_max[node], 0)
+    return float(np.sum((below + above) ** 2))
+
+  def nearest(self, target, k=10, mask=None):
+    """Returns (row indices, euclidean distances) of the k closest points, closest first."""
+    target = np.asarray(target, dtype=np.float32)
+    best_i = np.empty(0, dtype=np.int64)
+    best_d = np.empty(0, dtype=np.float32)
+    if not len(self.start):
+      return best_i, best_d
+
+    queue = [(0.0, 0)] # (squared distance to node box, node), best first
+    while queue:
+      dist, node = heapq.heappop(queue)
+      if len(best_d) == k and dist > best_d[-1]:
+        break
+      if self.left[node] == -1:
+        rows = self.idx[self.start[node]:self.end[node]]
+        if mask is not None:
+          rows = rows[mask[rows]]
+        d = np.sum((self.points[rows] - target) ** 2, axis=1)
+        best_i = np.concatenate([best_i, rows])
+        best_d = np.concatenate([best_d, d])
+        order = np.argsort(best_d, kind='stable')[:k]
+        best_i, best_d = best_i[order], best_d[order]
+      else:
+        for child in (self.left[node], self.right[node]):
+          heapq.heappush(queue, (self._box_distance(child, target), child))
+    return best_i, np.sqrt(best_d)
+
+  def within(self, low, high, mask=None):
+    """Row indices of every point inside the box [low, high] (inclusive)."""
+    low = np.asarray(low, dtype=np.float32)
+    high = np.asarray(high, dtype=np.float32)
+    found = []
+    stack = [0] if len(self.start) else []
+    while stack:
+      node = stack.pop()
+      if np.any(self.box_min[node] > high) or np.any(self.box_max[node] < low):
+        continue # no overlap
+      rows = self.idx[self.start[node]:self.end[node]]
+      if np.all(self.box_min[node] >= low) and np.all(self.box_max[node] <= high):
+        found.append(rows) # node entirely inside the box
+      elif self.left[node] == -1:
+        pts = self.points[rows]
+        found.append(rows[np.all((pts >= low) & (pts <= high), axis=1)])
+      else:
+        stack.extend((self.left[node], self.right[node]))
+    rows = np.sort(np.concatenate(found)) if found else np.empty(0, dtype=np.int64)
+    if mask is not None:
+      rows = rows[mask[rows]]
+    return rows
+
+# below this many candidate rows a plain scan beats walking the tree
+# (a selective mask, e.g. one artist, makes the tree visit most of its leaves)
+BRUTE_FORCE_ROWS = 50000
+
+class MoodIndex:
+  def __init__(self, store, features=MOOD_FEATURES, leaf_size=32):
+    self.features = tuple(features)
+    points = np.column_stack([normalize(name, store.features[name]) for name in self.features])
+
+    # tracks with a missing feature can't be placed, leave them out of the tree
+    valid = np.flatnonzero(np.isfinite(points).all(axis=1))
+    self.rows = valid
+    self.tree = KDTree(points[valid], leaf_size=leaf_size)
+
+  def _point(self, values):
+    return np.array([normalize(name, values[name]) for name in self.features])
+
+  def nearest(self, target, k=10, mask=None):
+    """`target` maps feature name -> value; returns (store rows, distances)."""
+    point = self._point(target).astype(np.float32)
+    tree_mask = None if mask is None else mask[self.rows]
+    if tree_mask is not None and np.count_nonzero(tree_mask) <= BRUTE_FORCE_ROWS:
+      candidates = np.flatnonzero(tree_mask)
+      d = np.sum((self.tree.points[candidates] - point) ** 2, axis=1)
+      order = np.argsort(d, kind='stable')[:k]
+      return self.rows[candidates[order]], np.sqrt(d[order])
+    found, distances = self.tree.nearest(point, k, tree_mask)
+    return self.rows[found], distances
+
+  def within(self, bounds, mask=None):
+    """`bounds` maps feature name -> (low, high); returns store rows in store order."""
+    low = self._point({name: bounds[name][0] for name in self.features}).astype(np.float32)
+    high = self._point({name: bounds[name][1] for name in self.features}).astype(np.float32)
+    tree_mask = None if mask is None else mask[self.rows]
+    if tree_mask is not None and np.count_nonzero(tree_mask) <= BRUTE_FORCE_ROWS:
+      candidates = np.flatnonzero(tree_mask)
+      pts = self.tree.points[candidates]
+      return self.rows[candidates[np.all((pts >= low) & (pts <= high), axis=1)]]
+    return self.rows[self.tree.within(low, high, tree_mask)]
+
+def mood_distance(df, target, features=MOOD_FEATURES):
+  # brute force version of the tree distance, for frames that didn't come from the store
+  squared = sum((normalize(name, df[name]) - normalize(name, target[name])) ** 2 for name in features)
+  return np.sqrt(squared)
+
+_indexes = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+def get_mood_index(store):
+  index = _indexes.get(store)
+  if index is None:
+    with _lock:
+      index = _indexes.get(store)
+      if index is None:
+        index = MoodIndex(store)
+        _indexes[store] = index
+  return index
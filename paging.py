@@ -0,0 +1,144 @@
+# keyset pagination for the "show original dataset" tables
+#
+# a page is asked for by the (sort key, id) of the last row before it instead of an
+# offset, so every page is one index range scan of page_size rows however deep into
+# the table it is, and only the page's columns are read and sent to the browser.
+#
+# rows are ordered by (sort key, id) with null keys first; descending is the exact
+# reverse. the same order is implemented three times: as sql (SQLiteStorage), and
+# over numpy arrays (FeatureStore, and ParquetStorage after predicate pushdown).
+
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+PAGE_SIZE = int(os.environ.get('PAGE_SIZE', 50))
+MAX_PAGERS = 256
+
+def keyset_sql(sort_by, descending, after):
+  # where clause (+ params) for the rows after cursor `after` = (key, id), or None
+  if after is None:
+    return None, ()
+  key, id = after
+  if descending: # nulls come last
+    if key is None:
+      return f'({sort_by} is null and id < ?)', (id,)
+    return f'(({sort_by}, id) < (?, ?) or {sort_by} is null)', (key, id)
+  if key is None: # nulls come first
+    return f'({sort_by} is not null or id > ?)', (id,)
+  return f'(({sort_by}, id) > (?, ?))', (key, id)
+
+def order_sql(sort_by, descending):
+  direction = 'desc' if descending else 'asc'
+  return f'order by {sort_by} {direction}, id {direction}'
+
+def _null(value):
+  return value is None or pd.isnull(value)
+
+def page_positions(keys, ids, descending=False, after=None, limit=PAGE_SIZE):
+  # positions of the (at most) `limit` rows after cursor `after`, in page order
+  if limit == 0:
+    return np.zeros(0, dtype=np.int64)
+  nulls = pd.isnull(keys)
+  if after is None:
+    later = np.ones(len(keys), dtype=bool)
+  else:
+    key, id = after
+    with np.errstate(invalid='ignore'): # comparisons with nan / nat are False, as in sql
+      if _null(key):
+        later = nulls & (ids < id) if descending else ~nulls | (ids > id)
+      elif descending:
+        later = (keys < key) | (keys == key) & (ids < id) | nulls
+      else:
+        later = (keys > key) | (keys == key) & (ids > id)
+
+  positions = np.flatnonzero(later)
+  # one sortable number per row with nulls smallest (nat already is the smallest int64)
+  if np.issubdtype(keys.dtype, np.datetime64):
+    sortable = keys[positions].view(np.int64)
+  else:
+    sortable = np.where(nulls[positions], -np.inf, keys[positions])
+  if len(positions) > limit: # only sort the rows that can make the page (ties on the cutoff included)
+    if descending:
+      keep = sortable >= np.partition(sortable, len(sortable) - limit)[len(sortable) - limit]
+    else:
+      keep = sortable <= np.partition(sortable, limit - 1)[limit - 1]
+    positions, sortable = positions[keep], sortable[keep]
+  order = np.lexsort((ids[positions], sortable))
+  if descending:
+    order = order[::-1]
+  return positions[order[:limit]]
+
+def cursor(key, id):
+  return (None if _null(key) else key, int(id))
+
+class Pager:
+  """
+  Pages of one table ordering (source, artist, sort key, direction). Remembers the
+  cursor every visited page starts at, so the next / previous page is a single keyset
+  query and a jump to page n only reads the (key, id) pairs of the pages in between.
+  `source` is anything with a page(columns, artist, sort_by, descending, after, limit)
+  -> (df, keys) method: a FeatureStore or a Storage.
+  """
+  def __init__(self, source, artist, sort_by, descending, page_size=PAGE_SIZE):
+    self.source = source
+    self.artist = artist
+    self.sort_by = sort_by
+    self.descending = descending
+    self.page_size = page_size
+    self.starts = [None] # starts[n]: cursor of the last row before page n
+    self._lock = threading.Lock()
+
+  def _fetch(self, columns, after, limit):
+    return self.source.page(columns, self.artist, self.sort_by, self.descending, after, limit)
+
+  def _start(self, n):
+    with self._lock:
+      known = min(n, len(self.starts) - 1)
+      if known < n:
+        # walk the keys from the last known page start, keeping every page_size-th
+        _, keys = self._fetch((), self.starts[known], (n - known) * self.page_size)
+        self.starts.extend(keys[i] for i in range(self.page_size - 1, len(keys), self.page_size))
+      return self.starts[n] if n < len(self.starts) else False # False: past the last page
+
+  def page(self, n, columns):
+    after = self._start(n)
+    if after is False:
+      return self._fetch(columns, None, 0)[0]
+    df, keys = self._fetch(columns, after, self.page_size)
+    if len(keys) == self.page_size:
+      with self._lock:
+        if len(self.starts) == n + 1:
+          self.starts.append(keys[-1])
+    return df
+
+_pagers = OrderedDict()
+_lock = threading.Lock()
+
+def get_pager(db_key, source, artist, sort_by, descending, page_size=PAGE_SIZE):
+  # one pager per database version, table ordering and backend, shared by every
+  # session (least recently used dropped)
+  key = (db_key, getattr(source, 'name', type(source).__name__), artist, sort_by, descending, page_size)
+  with _lock:
+    pager = _pagers.get(key)
+    if pager is None:
+      pager = _pagers[key] = Pager(source, artist, sort_by, descending, page_size)
+      if len(_pagers) > MAX_PAGERS:
+        _pagers.popitem(last=False)
+    else:
+      _pagers.move_to_end(key)
+      pager.source = source
+  return pager
+
+def frame_page(df, n, sort_by=None, descending=False, columns=None, page_size=PAGE_SIZE):
+  # the same paging for a frame that's already in memory (per-album tables): sort, then slice
+  if sort_by is not None:
+    df = df.sort_values(sort_by, ascending=not descending, kind='mergesort', na_position='last' if descending else 'first')
+  df = df.iloc[n * page_size:(n + 1) * page_size]
+  return df if columns is None else df[list(columns)]
+
+def n_pages(n_rows, page_size=PAGE_SIZE):
+  return max(-(-n_rows // page_size), 1)
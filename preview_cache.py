@@ -0,0 +1,98 @@
+# on-disk cache of spotify preview lookups
+#
+# kept in its own sqlite file (billboard-200.db is opened read-only), keyed on the
+# normalized search query. tracks without a preview are cached too (preview_url is
+# null) but expire sooner, and the oldest-used entries are evicted above a size cap.
+
+import os
+import time
+import sqlite3
+import threading
+
+CACHE_PATH = os.environ.get('PREVIEW_CACHE_PATH', './preview-cache.db')
+CACHE_TTL = float(os.environ.get('PREVIEW_CACHE_TTL', 7 * 24 * 3600)) # seconds
+NEGATIVE_TTL = float(os.environ.get('PREVIEW_CACHE_NEGATIVE_TTL', 24 * 3600))
+MAX_ENTRIES = int(os.environ.get('PREVIEW_CACHE_MAX_ENTRIES', 20000))
+
+def normalize(query):
+  return ' '.join(query.lower().split())
+
+class PreviewCache:
+  def __init__(self, path=CACHE_PATH, ttl=CACHE_TTL, negative_ttl=NEGATIVE_TTL, max_entries=MAX_ENTRIES, clock=time.time):
+    self.path = path
+    self.ttl = ttl
+    self.negative_ttl = negative_ttl
+    self.max_entries = max_entries
+    self.clock = clock
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self._lock = threading.Lock()
+    self._conn = None
+
+  def _connection(self):
+    if self._conn is None:
+      self._conn = sqlite3.connect(self.path, check_same_thread=False)
+      self._conn.execute('pragma journal_mode = wal') # other processes may read / write it too
+      self._conn.execute('''
+        create table if not exists previews (
+          query text primary key,
+          preview_url text,
+          fetched_at real,
+          last_used real
+        )
+      ''')
+      self._conn.execute('create index if not exists previews_last_used on previews (last_used)')
+    return self._conn
+
+  def get(self, query):
+    """Returns (hit, preview_url); preview_url is None for a cached "no preview"."""
+    key = normalize(query)
+    now = self.clock()
+    with self._lock:
+      conn = self._connection()
+      row = conn.execute('select preview_url, fetched_at from previews where query = ?', (key,)).fetchone()
+      if row is not None:
+        preview_url, fetched_at = row
+        ttl = self.ttl if preview_url is not None else self.negative_ttl
+        if now - fetched_at < ttl:
+          with conn:
+            conn.execute('update previews set last_used = ? where query = ?', (now, key))
+          self.hits += 1
+          return True, preview_url
+      self.misses += 1
+      return False, None
+
+  def put(self, query, preview_url):
+    key = normalize(query)
+    now = self.clock()
+    with self._lock:
+      conn = self._connection()
+      with conn:
+        conn.execute(
+          'insert or replace into previews (query, preview_url, fetched_at, last_used) values (?, ?, ?, ?)',
+          (key, preview_url, now, now)
+        )
+        size = conn.execute('select count(*) from previews').fetchone()[0]
+        if size > self.max_entries:
+          # least recently used first
+          cur = conn.execute(
+            'delete from previews where query in (select query from previews order by last_used limit ?)',
+            (size - self.max_entries,)
+          )
+          self.evictions += cur.rowcount
+
+  def stats(self):
+    lookups = self.hits + self.misses
+    return {
+      'hits': self.hits,
+      'misses': self.misses,
+      'evictions': self.evictions,
+      'hit_rate': self.hits / lookups if lookups else 0.0,
+    }
+
+  def clear(self):
+    with self._lock:
+      conn = self._connection()
+      with conn:
+        conn.execute('delete from previews')
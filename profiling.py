@@ -0,0 +1,184 @@
+# lightweight per-rerun profiling: stage timers, rows returned, bytes sent to the
+# frontend and spotify http latency.
+#
+# every streamlit rerun starts a Profile (see streamlit_app.py); code anywhere below
+# it records into the current one through `stage`, `timed` and `record_http`, and
+# does nothing extra when no profile is active. finished profiles are appended to
+# a json-lines log:
+#
+# $ PROFILE_LOG=profile.jsonl streamlit run streamlit_app.py
+# $ python profiling.py profile.jsonl     # p50 / p95 / max per stage
+#
+# STARTUP_TIMING=1 prints the cost of the script's imports and of its first render.
+
+import os
+import sys
+import json
+import time
+import threading
+import contextvars
+import functools
+from contextlib import contextmanager
+
+# append every rerun's profile to this file ('' = don't log)
+LOG_PATH = os.environ.get('PROFILE_LOG', '')
+# show the "show timings" checkbox in the sidebar
+DEBUG_PANEL = os.environ.get('DEBUG_PANEL', '0') == '1'
+# report what the first run of the script spent on imports and on its first render
+STARTUP_TIMING = os.environ.get('STARTUP_TIMING', '0') == '1'
+
+# a context variable rather than a global, so concurrent sessions don't mix their numbers
+_current = contextvars.ContextVar('profile', default=None)
+_log_lock = threading.Lock()
+
+class Profile:
+  def __init__(self, page='main', detailed=False):
+    self.page = page
+    self.detailed = detailed # also measure the things that cost something (chart bytes)
+    self.started = time.time()
+    self._start = time.perf_counter()
+    self.stages = []
+    self.http = []
+    self.total_ms = None
+    self._lock = threading.Lock() # http timings come in from the spotify worker threads
+
+  def add(self, name, ms, rows=None, bytes=None):
+    with self._lock:
+      self.stages.append({'stage': name, 'ms': round(ms, 3), 'rows': rows, 'bytes': bytes})
+
+  def add_http(self, name, ms, status):
+    with self._lock:
+      self.http.append({'request': name, 'ms': round(ms, 3), 'status': status})
+
+  def finish(self):
+    self.total_ms = round((time.perf_counter() - self._start) * 1000, 3)
+    return self
+
+  def frame(self):
+    # one row per stage plus one summary row for the spotify calls, for the debug panel
+    import pandas as pd
+    df = pd.DataFrame(self.stages, columns=['stage', 'ms', 'rows', 'bytes'])
+    if self.http:
+      times = [call['ms'] for call in self.http]
+      http = {'stage': f'http ({len(times)} calls, max {max(times):.0f} ms)', 'ms': sum(times), 'rows': None, 'bytes': None}
+      df = pd.concat([df, pd.DataFrame([http])], ignore_index=True)
+    return df
+
+  def to_dict(self):
+    return {
+      'page': self.page,
+      'started': self.started,
+      'total_ms': self.total_ms,
+      'stages': self.stages,
+      'http': self.http,
+    }
+
+def start(page='main', detailed=False):
+  profile = Profile(page, detailed)
+  _current.set(profile)
+  return profile
+
+def current():
+  return _current.get()
+
+def _size(result):
+  # rows in a frame / series / array / list result
+  if isinstance(result, (str, bytes, dict)) or not hasattr(result, '__len__'):
+    return None
+  return len(result)
+
+@contextmanager
+def stage(name):
+  """
+  Times the block as stage `name` of the current profile. Yields a dict the block
+  can put `rows` / `bytes` into.
+  """
+  info = {}
+  start = time.perf_counter()
+  try:
+    yield info
+  finally:
+    profile = _current.get()
+    if profile is not None:
+      profile.add(name, (time.perf_counter() - start) * 1000, info.get('rows'), info.get('bytes'))
+
+def timed(func):
+  # records every call of func as a stage, with the number of rows it returned
+  @functools.wraps(func)
+  def wrapper(*args, **kwargs):
+    if _current.get() is None:
+      return func(*args, **kwargs)
+    with stage(func.__name__) as info:
+      result = func(*args, **kwargs)
+      info['rows'] = _size(result)
+    return result
+  return wrapper
+
+def record_http(name, ms, status):
+  profile = _current.get()
+  if profile is not None:
+    profile.add_http(name, ms, status)
+
+def payload_bytes(chart):
+  # size of the spec streamlit sends for an altair / plotly chart; serializing it
+  # again costs as much as rendering, so only when the profile asked for details
+  profile = _current.get()
+  if profile is None or not profile.detailed:
+    return None
+  return len(chart.to_json())
+
+# startup timing: streamlit re-executes the script on every rerun but its imports
+# only cost something the first time, so this is recorded once per process
+
+_startup = {'imports': [], 'reported': False}
+
+@contextmanager
+def startup_import(name):
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    if STARTUP_TIMING and not _startup['reported']:
+      _startup['imports'].append({'stage': f'import {name}', 'ms': round((time.perf_counter() - start) * 1000, 3)})
+
+def report_startup(profile):
+  # called at the end of every run, prints / logs only after the first one
+  if not STARTUP_TIMING or _startup['reported']:
+    return
+  _startup['reported'] = True
+  imports = sum(item['ms'] for item in _startup['imports'])
+  print(f'startup: imports {imports:.0f} ms, first render {profile.total_ms:.0f} ms')
+  for item in _startup['imports'] + sorted(profile.stages, key=lambda item: -item['ms']):
+    print(f"  {item['stage']:<32} {item['ms']:>10.1f} ms")
+  startup = Profile('startup')
+  startup.stages = _startup['imports'] + [{'stage': 'first render', 'ms': profile.total_ms, 'rows': None, 'bytes': None}]
+  startup.total_ms = imports + profile.total_ms
+  write_log(startup)
+
+def write_log(profile, path=None):
+  path = path or LOG_PATH
+  if not path:
+    return
+  line = json.dumps(profile.to_dict())
+  with _log_lock, open(path, 'a') as f:
+    f.write(line + '\n')
+
+def summarize(path):
+  # p50 / p95 / max per stage over every profile in a log
+  import pandas as pd
+  rows = []
+  with open(path) as f:
+    for line in f:
+      if not line.strip():
+        continue
+      profile = json.loads(line)
+      rows.append({'stage': 'total', 'ms': profile['total_ms']})
+      rows.extend({'stage': s['stage'], 'ms': s['ms']} for s in profile['stages'])
+      rows.extend({'stage': 'http ' + h['request'], 'ms': h['ms']} for h in profile['http'])
+  df = pd.DataFrame(rows, columns=['stage', 'ms'])
+  return df.groupby('stage')['ms'].describe(percentiles=[0.5, 0.95])[['count', '50%', '95%', 'max']].sort_values('95%', ascending=False)
+
+if __name__ == '__main__':
+  if len(sys.argv) != 2:
+    sys.exit('usage: python profiling.py <profile.jsonl>')
+  print(summarize(sys.argv[1]).to_string(float_format=lambda ms: f'{ms:.1f}'))
@@ -0,0 +1,103 @@
+# in-memory cache of query results, shared by every session in the process
+#
+# keyed on the normalized query, bounded by an (estimated) memory budget with
+# least-recently-used eviction, and keeps hit / miss counts for the debug panel.
+# cached values are shared between sessions: callers must not modify them.
+
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+MOOD_CACHE_MAX_BYTES = int(os.environ.get('MOOD_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+
+# the search sliders move in steps of 0.01
+SLIDER_STEP = 0.01
+
+def quantize(bounds, step=SLIDER_STEP):
+  # (low, high) -> whole slider steps, so 0.5 and 0.5000000001 are the same key
+  return tuple(int(round(value / step)) for value in bounds)
+
+def dequantize(steps, step=SLIDER_STEP):
+  return tuple(round(value * step, 10) for value in steps)
+
+def sizeof(value):
+  # rough size of a cached value in bytes
+  if hasattr(value, 'memory_usage'): # dataframe
+    return int(value.memory_usage(index=True, deep=True).sum())
+  if hasattr(value, 'to_json'): # plotly figure
+    return len(value.to_json())
+  if isinstance(value, (tuple, list)):
+    return sys.getsizeof(value) + sum(sizeof(item) for item in value)
+  return sys.getsizeof(value)
+
+class ResultCache:
+  def __init__(self, max_bytes, sizeof=sizeof):
+    self.max_bytes = max_bytes
+    self.sizeof = sizeof
+    self.bytes = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self._entries = OrderedDict() # key -> (value, size), least recently used first
+    self._lock = threading.Lock()
+
+  def get(self, key):
+    """Returns (hit, value)."""
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is None:
+        self.misses += 1
+        return False, None
+      self._entries.move_to_end(key)
+      self.hits += 1
+      return True, entry[0]
+
+  def put(self, key, value):
+    size = self.sizeof(value)
+    if size > self.max_bytes: # would evict everything else, don't cache it
+      return
+    with self._lock:
+      old = self._entries.pop(key, None)
+      if old is not None:
+        self.bytes -= old[1]
+      self._entries[key] = (value, size)
+      self.bytes += size
+      while self.bytes > self.max_bytes:
+        _, (_, evicted) = self._entries.popitem(last=False)
+        self.bytes -= evicted
+        self.evictions += 1
+
+  def get_or_compute(self, key, compute):
+    # two sessions missing the same key at once both compute it, the second put wins
+    hit, value = self.get(key)
+    if not hit:
+      value = compute()
+      self.put(key, value)
+    return value
+
+  def discard(self, stale):
+    # drops every entry whose key `stale(key)` is true, e.g. results from an old data version
+    with self._lock:
+      for key in [key for key in self._entries if stale(key)]:
+        self.bytes -= self._entries.pop(key)[1]
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+      self.bytes = 0
+
+  def stats(self):
+    with self._lock:
+      lookups = self.hits + self.misses
+      return {
+        'entries': len(self._entries),
+        'bytes': self.bytes,
+        'hits': self.hits,
+        'misses': self.misses,
+        'hit_rate': self.hits / lookups if lookups else 0.0,
+        'evictions': self.evictions,
+      }
+
+# "which songs fit my mood?" results: top recommendations + their chart
+mood_cache = ResultCache(MOOD_CACHE_MAX_BYTES)
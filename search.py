@@ -0,0 +1,137 @@
+# artist / album / song lookup over acoustic_features
+#
+# build step (needs a writable connection, run from get_connection or
+# `python search.py <db>`):
+#   - b-tree indexes on acoustic_features (artist, date, id), (date, id) and (album);
+#     (the two date ones also serve the keyset pages of paging.py)
+#   - an `artists` table, one row per artist with its track count
+#   - fts5 tables over artist names and over song / album / artist, with prefix
+#     indexes for typeahead
+# queries take the read-only ConnectionPool from db.py.
+
+import re
+import sys
+import sqlite3
+from sqlite3 import Connection
+
+from aggregates import is_fresh, mark_built
+from db import has_table
+
+def build_search_index(conn: Connection):
+  with conn:
+    conn.execute('drop index if exists acoustic_features_artist_date') # superseded by the one below
+    conn.execute('create index if not exists acoustic_features_artist_date_id on acoustic_features (artist, date, id)')
+    conn.execute('create index if not exists acoustic_features_date_id on acoustic_features (date, id)')
+    conn.execute('create index if not exists acoustic_features_album on acoustic_features (album)')
+    # neighbour lookups in get_similar_tracks; ingest.ensure_table makes it unique, a
+    # database that was never ingested into (e.g. the shipped file) has none
+    conn.execute('create index if not exists acoustic_features_id on acoustic_features (id)')
+
+    conn.execute('drop table if exists artists')
+    conn.execute('''
+      create table artists (
+        artist_id integer primary key,
+        name text not null unique,
+        n_tracks integer
+      )
+    ''')
+    conn.execute('''
+      insert into artists (name, n_tracks)
+      select artist, count(*) from acoustic_features where artist is not null group by artist
+    ''')
+
+    try:
+      conn.execute('drop table if exists artist_search')
+      conn.execute("create virtual table artist_search using fts5(name, content='artists', content_rowid='artist_id', prefix='2 3')")
+      conn.execute("insert into artist_search (artist_search) values ('rebuild')")
+
+      conn.execute('drop table if exists track_search')
+      conn.execute('''
+        create virtual table track_search using fts5(
+          song, album, artist,
+          content='acoustic_features', content_rowid='rowid',
+          tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )
+      ''')
+      conn.execute("insert into track_search (track_search) values ('rebuild')")
+    except sqlite3.OperationalError as e: # sqlite built without fts5, the LIKE fallbacks below still work
+      print(e)
+
+    mark_built(conn, 'search_index')
+
+SEARCH_INDEXES = ('acoustic_features_artist_date_id', 'acoustic_features_date_id', 'acoustic_features_album', 'acoustic_features_id')
+
+def ensure_search_index(conn: Connection):
+  existing = {row[0] for row in conn.execute("select name from sqlite_master where type = 'index'")}
+  if not is_fresh(conn, 'search_index') or not existing.issuperset(SEARCH_INDEXES):
+    build_search_index(conn)
+
+def fts_query(text, column=None):
+  # every word of the input becomes a quoted prefix term: 'david bo' -> "david"* "bo"*
+  words = re.findall(r'\w+', text.lower())
+  terms = ' '.join('"' + word.replace('"', '""') + '"*' for word in words)
+  if column and terms:
+    return f'{column} : ({terms})'
+  return terms
+
+def search_artists(pool, text, limit=10):
+  """Typeahead over artist names, most prolific first."""
+  query = fts_query(text)
+  if not query:
+    return pool.read_sql('select name, n_tracks from artists order by n_tracks desc limit ?', (limit,))
+  if has_table(pool, 'artist_search'):
+    return pool.read_sql('''
+      select a.name, a.n_tracks
+      from artist_search s join artists a on a.artist_id = s.rowid
+      where artist_search match ?
+      order by a.n_tracks desc
+      limit ?
+    ''', (query, limit))
+  return pool.read_sql('select name, n_tracks from artists where name like ? order by n_tracks desc limit ?', (text.strip() + '%', limit))
+
+def search_tracks(pool, text, artist=None, limit=20):
+  """Songs whose song / album / artist words start with the words typed so far."""
+  query = fts_query(text)
+  if not query:
+    return pool.read_sql('select id, song, artist, album, date from acoustic_features limit 0')
+  if has_table(pool, 'track_search'):
+    return pool.read_sql('''
+      select f.id, f.song, f.artist, f.album, f.date
+      from track_search s join acoustic_features f on f.rowid = s.rowid
+      where track_search match ? and (? is null or f.artist = ?)
+      order by s.rank
+      limit ?
+    ''', (query, artist, artist, limit))
+  like = '%' + text.strip() + '%'
+  return pool.read_sql('''
+    select id, song, artist, album, date from acoustic_features
+    where (song like ? or album like ?) and (? is null or artist = ?)
+    limit ?
+  ''', (like, like, artist, artist, limit))
+
+def search_albums(pool, text, artist=None, limit=20):
+  """Albums whose title words start with the words typed so far."""
+  query = fts_query(text, 'album')
+  if not query:
+    return pool.read_sql('select album, artist, min(date) as date from acoustic_features limit 0')
+  if has_table(pool, 'track_search'):
+    return pool.read_sql('''
+      select f.album, f.artist, min(f.date) as date
+      from track_search s join acoustic_features f on f.rowid = s.rowid
+      where track_search match ? and (? is null or f.artist = ?)
+      group by f.album, f.artist
+      order by count(*) desc
+      limit ?
+    ''', (query, artist, artist, limit))
+  return pool.read_sql('''
+    select album, artist, min(date) as date from acoustic_features
+    where album like ? and (? is null or artist = ?)
+    group by album, artist
+    limit ?
+  ''', ('%' + text.strip() + '%', artist, artist, limit))
+
+if __name__ == '__main__':
+  path = sys.argv[1] if len(sys.argv) > 1 else './billboard-200.db'
+  conn = sqlite3.connect(path)
+  build_search_index(conn)
+  print(f'built search index in {path}')
@@ -0,0 +1,173 @@
+# "more like this": the k most acoustically similar tracks of every track
+#
+# offline job, too slow for app startup:
+# $ python similar.py billboard-200.db --k 10 --workers 8
+#
+# every track is a point of its five features scaled to 0-1 (mood_index.FEATURE_RANGES).
+# all pairs would be ~10^11 distances, so:
+#   - points are put in kd-tree order (mood_index.KDTree), so consecutive rows are close
+#     together and a run of rows (a block / chunk) has a small bounding box
+#   - a process pool works through blocks of query rows; a block's squared distances to
+#     one corpus chunk at a time are a dense matrix product (|q|^2 + |x|^2 - 2 q.x),
+#     keeping a running top-k per row, so memory stays at block x chunk floats
+#   - chunks are visited nearest box first, and once a chunk's box is further away than
+#     every row's current k-th neighbour the remaining chunks are skipped
+#
+# results go to similar_tracks (track_id, rank, neighbour_id, score), a without-rowid
+# table clustered on (track_id, rank), so one track's neighbours are a single b-tree
+# range read. other versions of the same song (remasters, reissues) are skipped.
+
+import os
+import time
+import sqlite3
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from aggregates import mark_built
+from db import FEATURES
+from mood_index import KDTree, normalize
+
+BLOCK_ROWS = 128 # query rows per task
+CHUNK_ROWS = 512 # corpus rows per distance matrix
+EXTRA = 10 # candidates kept beyond k, so dropping other versions still leaves k
+
+def song_key(songs, artists):
+  # same song = same title (before " - Remastered ..."), case-insensitive, by the same artist
+  titles = songs.fillna('').str.split(' - ', n=1).str[0].str.strip().str.casefold()
+  codes, _ = pd.factorize(titles + '\x00' + artists.fillna(''))
+  return codes.astype(np.int32)
+
+def load_points(conn):
+  df = pd.read_sql(f'select id, song, artist, {", ".join(FEATURES)} from acoustic_features order by id', conn)
+  df = df.dropna(subset=list(FEATURES)).reset_index(drop=True) # tracks without features get no neighbours
+  points = np.column_stack([normalize(name, df[name]) for name in FEATURES]).astype(np.float32)
+  order = KDTree(points).idx # spatially close points end up next to each other
+  return df['id'].to_numpy(dtype=np.int64)[order], points[order], song_key(df['song'], df['artist'])[order]
+
+def _boxes(points, rows):
+  starts = range(0, len(points), rows)
+  return (
+    np.array([points[start:start + rows].min(axis=0) for start in starts]),
+    np.array([points[start:start + rows].max(axis=0) for start in starts]),
+  )
+
+_points = None # per worker process
+_norms = None
+_keys = None
+_chunk_min = None
+_chunk_max = None
+
+def _init_worker(points, keys):
+  global _points, _norms, _keys, _chunk_min, _chunk_max
+  _points = points
+  _norms = np.einsum('ij,ij->i', points, points)
+  _keys = keys
+  _chunk_min, _chunk_max = _boxes(points, CHUNK_ROWS)
+
+def _block_neighbours(start, stop, k):
+  # top k (position, squared distance) of rows [start, stop) over the whole corpus
+  query = _points[start:stop]
+  query_norms = _norms[start:stop]
+  keep = k + EXTRA
+  best_pos = np.full((len(query), keep), -1, dtype=np.int64)
+  best_d2 = np.full((len(query), keep), np.inf, dtype=np.float32)
+
+  # squared distance between the block's bounding box and every chunk's
+  gap = np.maximum(_chunk_min - query.max(axis=0), 0) + np.maximum(query.min(axis=0) - _chunk_max, 0)
+  box_d2 = np.einsum('ij,ij->i', gap, gap)
+
+  for c in np.argsort(box_d2, kind='stable'):
+    if box_d2[c] > best_d2.max(): # nothing in this chunk (or any later one) can make it
+      break
+    chunk = c * CHUNK_ROWS
+    block = _points[chunk:chunk + CHUNK_ROWS]
+    d2 = query_norms[:, None] + _norms[None, chunk:chunk + len(block)] - 2 * (query @ block.T)
+
+    # only the few entries closer than their row's current worst are merged in
+    rows, cols = np.nonzero(d2 < best_d2.max(axis=1)[:, None])
+    if not len(rows):
+      continue
+    counts = np.bincount(rows, minlength=len(query))
+    slots = np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+    new_d2 = np.full((len(query), counts.max()), np.inf, dtype=np.float32)
+    new_pos = np.full((len(query), counts.max()), -1, dtype=np.int64)
+    new_d2[rows, slots] = d2[rows, cols]
+    new_pos[rows, slots] = chunk + cols
+
+    merged_d2 = np.concatenate([best_d2, new_d2], axis=1)
+    merged_pos = np.concatenate([best_pos, new_pos], axis=1)
+    top = np.argpartition(merged_d2, keep - 1, axis=1)[:, :keep]
+    best_d2, best_pos = np.take_along_axis(merged_d2, top, axis=1), np.take_along_axis(merged_pos, top, axis=1)
+
+  order = np.argsort(best_d2, axis=1, kind='stable')
+  best_d2, best_pos = np.take_along_axis(best_d2, order, axis=1), np.take_along_axis(best_pos, order, axis=1)
+
+  # drop the track itself and other versions of it, and repeats of the same neighbour song
+  positions, distances = [], []
+  for row in range(len(query)):
+    seen = {_keys[start + row]}
+    kept_pos, kept_d2 = [], []
+    for p, d in zip(best_pos[row], best_d2[row]):
+      if p < 0: # corpus smaller than k
+        break
+      if _keys[p] in seen:
+        continue
+      seen.add(_keys[p])
+      kept_pos.append(p)
+      kept_d2.append(d)
+      if len(kept_pos) == k:
+        break
+    positions.append(kept_pos)
+    distances.append(kept_d2)
+  return start, positions, distances
+
+def build_similar_tracks(conn, k=10, workers=os.cpu_count()):
+  ids, points, keys = load_points(conn)
+  max_distance = np.sqrt(len(FEATURES)) # features are in 0-1, score = 1 - distance / max
+  blocks = [(start, min(start + BLOCK_ROWS, len(ids))) for start in range(0, len(ids), BLOCK_ROWS)]
+
+  with conn:
+    conn.execute('drop table if exists similar_tracks')
+    conn.execute('''
+      create table similar_tracks (
+        track_id integer,
+        rank integer,
+        neighbour_id integer,
+        score real,
+        primary key (track_id, rank)
+      ) without rowid
+    ''')
+
+    done = 0
+    start_time = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(points, keys)) as executor:
+      futures = [executor.submit(_block_neighbours, start, stop, k) for start, stop in blocks]
+      for future in futures:
+        start, positions, distances = future.result()
+        # blocks are in kd-tree order, not id order: sorting a block's rows by key at
+        # least keeps its inserts into the clustered table sequential
+        rows = sorted(
+          (int(ids[start + row]), rank, int(ids[p]), round(float(1 - np.sqrt(max(d, 0)) / max_distance), 4))
+          for row in range(len(positions))
+          for rank, (p, d) in enumerate(zip(positions[row], distances[row]))
+        )
+        conn.executemany('insert into similar_tracks values (?, ?, ?, ?)', rows)
+        done += len(positions)
+        rate = done / (time.perf_counter() - start_time)
+        print(f'\rsimilar_tracks: {done:,} / {len(ids):,} tracks ({rate:,.0f} tracks/s)', end='', flush=True)
+    print()
+    mark_built(conn, 'similar_tracks')
+  return done
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='precompute the k most similar tracks of every track')
+  parser.add_argument('db', nargs='?', default='./billboard-200.db')
+  parser.add_argument('--k', type=int, default=10)
+  parser.add_argument('--workers', type=int, default=os.cpu_count())
+  args = parser.parse_args()
+  start = time.perf_counter()
+  n = build_similar_tracks(sqlite3.connect(args.db), args.k, args.workers)
+  print(f'built similar_tracks for {n:,} tracks in {args.db} in {time.perf_counter() - start:.1f}s')
@@ -0,0 +1,156 @@
+# distribution sketches of every feature, per release year
+#
+# fixed-bin histograms: 0-1 features get 100 bins of 0.01 (the slider step), tempo
+# 250 bins of 1 bpm; values outside the range land in the end bins. histograms add
+# up, so a decade (or any range of years) is the sum of its years, and an ingest
+# batch is applied by subtracting the rows it replaces and adding the new ones
+# (apply_delta) instead of rescanning acoustic_features.
+#
+# the whole table is a few hundred KB (years x features x bins counts); percentile
+# ranks and box plot quantiles are read off the cumulative counts, accurate to
+# within one bin.
+#
+# build step (needs a writable connection): get_connection, ingest.py, or
+# `python sketches.py <db>`
+
+import sys
+import sqlite3
+from sqlite3 import Connection
+
+import numpy as np
+import pandas as pd
+
+from aggregates import is_fresh, mark_built
+from db import FEATURES
+
+# feature -> (low, high, bins)
+HISTOGRAM_BINS = {
+  'danceability': (0.0, 1.0, 100),
+  'energy': (0.0, 1.0, 100),
+  'instrumentalness': (0.0, 1.0, 100),
+  'valence': (0.0, 1.0, 100),
+  'tempo': (0.0, 250.0, 250),
+}
+
+def _years(dates):
+  # 'YYYY-...' -> year, anything else (undated tracks) -> NaN
+  return pd.to_numeric(pd.Series(dates, dtype=object).str[:4], errors='coerce')
+
+def histogram_counts(df):
+  """
+  {(year, feature): int64 counts} of a frame with a date column and the features.
+  Undated tracks and missing values are left out.
+  """
+  years = _years(df['date']).to_numpy()
+  dated = ~np.isnan(years)
+  counts = {}
+  for name in FEATURES:
+    low, high, bins = HISTOGRAM_BINS[name]
+    values = pd.to_numeric(df[name], errors='coerce').to_numpy(dtype=np.float64)
+    ok = dated & ~np.isnan(values)
+    if not ok.any():
+      continue
+    year_values, year_codes = np.unique(years[ok].astype(np.int64), return_inverse=True)
+    bin_codes = np.clip(((values[ok] - low) / (high - low) * bins).astype(np.int64), 0, bins - 1)
+    grid = np.bincount(year_codes * bins + bin_codes, minlength=len(year_values) * bins).reshape(len(year_values), bins)
+    for year, row in zip(year_values, grid):
+      counts[(int(year), name)] = row
+  return counts
+
+def _write(conn, counts):
+  conn.executemany(
+    'insert or replace into feature_histograms (year, feature, counts) values (?, ?, ?)',
+    [(year, name, row.astype(np.int64).tobytes()) for (year, name), row in counts.items()]
+  )
+
+def build_histograms(conn: Connection, chunk_rows=500000):
+  # one streamed pass over acoustic_features, counts are summed chunk by chunk
+  columns = ['date'] + list(FEATURES)
+  totals = {}
+  with conn:
+    conn.execute('drop table if exists feature_histograms')
+    conn.execute('create table feature_histograms (year integer, feature text, counts blob, primary key (year, feature)) without rowid')
+    cursor = conn.execute(f'select {", ".join(columns)} from acoustic_features')
+    while True:
+      rows = cursor.fetchmany(chunk_rows)
+      if not rows:
+        break
+      for key, row in histogram_counts(pd.DataFrame(rows, columns=columns)).items():
+        totals[key] = totals[key] + row if key in totals else row
+    _write(conn, totals)
+    mark_built(conn, 'feature_histograms')
+
+def ensure_histograms(conn: Connection):
+  if not is_fresh(conn, 'feature_histograms'):
+    build_histograms(conn)
+
+def apply_delta(conn: Connection, ids, sign, chunk_ids=500):
+  """
+  Adds (sign=1) or subtracts (sign=-1) the current acoustic_features rows with these
+  ids to / from the histograms. ingest.py calls it around each upserted batch, inside
+  the batch's transaction, so the histograms follow the table without a rebuild.
+  """
+  columns = ['date'] + list(FEATURES)
+  frames = []
+  for start in range(0, len(ids), chunk_ids): # stay under sqlite's bound parameter limit
+    chunk = ids[start:start + chunk_ids]
+    rows = conn.execute(f'select {", ".join(columns)} from acoustic_features where id in ({", ".join("?" * len(chunk))})', chunk).fetchall()
+    frames.append(pd.DataFrame(rows, columns=columns))
+  if not frames:
+    return
+  delta = histogram_counts(pd.concat(frames, ignore_index=True))
+  for (year, name), row in delta.items():
+    found = conn.execute('select counts from feature_histograms where year = ? and feature = ?', (year, name)).fetchone()
+    current = np.frombuffer(found[0], dtype=np.int64) if found else np.zeros(len(row), dtype=np.int64)
+    delta[(year, name)] = current + sign * row
+  _write(conn, delta)
+
+def load_histograms(conn):
+  # {feature: (years array, counts matrix years x bins)}, from the pool or a connection
+  rows = list(conn.execute('select year, feature, counts from feature_histograms order by feature, year'))
+  histograms = {}
+  for name in FEATURES:
+    found = [(year, np.frombuffer(blob, dtype=np.int64)) for year, feature, blob in rows if feature == name]
+    if found:
+      histograms[name] = (np.array([year for year, _ in found]), np.vstack([counts for _, counts in found]))
+  return histograms
+
+def merge(histograms, feature, start, end):
+  # counts of every track released in years [start, end]
+  years, counts = histograms[feature]
+  return counts[(years >= start) & (years <= end)].sum(axis=0)
+
+def percentile_rank(counts, feature, value):
+  # share (0-100) of the counted tracks below `value`, linear inside its bin
+  low, high, bins = HISTOGRAM_BINS[feature]
+  total = counts.sum()
+  if not total or value is None or np.isnan(value):
+    return np.nan
+  position = np.clip((value - low) / (high - low) * bins, 0, bins)
+  whole = int(min(position, bins - 1))
+  below = counts[:whole].sum() + counts[whole] * (position - whole)
+  return 100 * below / total
+
+def quantiles(counts, feature, qs):
+  # value at each quantile q (0-1) of the counted tracks, linear inside the bin it falls in
+  low, high, bins = HISTOGRAM_BINS[feature]
+  total = counts.sum()
+  if not total:
+    return [np.nan] * len(qs)
+  width = (high - low) / bins
+  cumulative = np.cumsum(counts)
+  values = []
+  for q in qs:
+    target = q * total
+    b = int(np.searchsorted(cumulative, target))
+    b = min(b, bins - 1)
+    before = cumulative[b - 1] if b else 0
+    inside = (target - before) / counts[b] if counts[b] else 0.0
+    values.append(low + (b + inside) * width)
+  return values
+
+if __name__ == '__main__':
+  path = sys.argv[1] if len(sys.argv) > 1 else './billboard-200.db'
+  conn = sqlite3.connect(path)
+  build_histograms(conn)
+  print(f'built feature_histograms in {path}')
@@ -0,0 +1,304 @@
+# spotify web api helpers (client credentials flow)
+
+import os
+import time
+import random
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, as_completed
+
+import profiling
+from preview_cache import PreviewCache
+
+SPOTIFY_CLIENT_ID = os.environ.get('SPOTIFY_CLIENT_ID')
+SPOTIFY_CLIENT_SECRET = os.environ.get('SPOTIFY_CLIENT_SECRET')
+
+# overridable so the client can be pointed at a local stub server
+TOKEN_URL = os.environ.get('SPOTIFY_TOKEN_URL', 'https://accounts.spotify.com/api/token')
+API_URL = os.environ.get('SPOTIFY_API_URL', 'https://api.spotify.com/v1')
+
+# (connect, read) timeout for every request, in seconds
+REQUEST_TIMEOUT = (3.05, 5)
+LOOKUP_WORKERS = 8
+# seconds a page waits for preview lookups before showing the rest without links
+PREVIEW_BUDGET = float(os.environ.get('PREVIEW_BUDGET', 1.5))
+
+# 429 / 5xx answers are retried up to MAX_RETRIES times, waiting Retry-After (or
+# exponential backoff) plus jitter; a Retry-After longer than MAX_BACKOFF isn't waited for
+MAX_RETRIES = int(os.environ.get('SPOTIFY_MAX_RETRIES', 2))
+BACKOFF_BASE = 0.25
+MAX_BACKOFF = 2.0
+# after BREAKER_FAILURES failed lookups in a row, lookups are skipped for BREAKER_COOLDOWN seconds
+BREAKER_FAILURES = int(os.environ.get('SPOTIFY_BREAKER_FAILURES', 5))
+BREAKER_COOLDOWN = float(os.environ.get('SPOTIFY_BREAKER_COOLDOWN', 30))
+
+# SPOTIFY_OFFLINE=1 only answers from the preview cache and never calls spotify
+OFFLINE = os.environ.get('SPOTIFY_OFFLINE', '0') == '1'
+
+# one keep-alive session (and worker pool) shared by all sessions, so a batch of
+# lookups reuses a few tls connections instead of opening one per song
+_session = None
+_session_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=LOOKUP_WORKERS, thread_name_prefix='spotify')
+
+def get_session():
+  # requests is only imported (and the session created) once the first lookup needs it
+  global _session
+  if _session is None:
+    with _session_lock:
+      if _session is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+        session = requests.Session()
+        session.mount('https://', HTTPAdapter(pool_connections=2, pool_maxsize=LOOKUP_WORKERS))
+        session.mount('http://', HTTPAdapter(pool_connections=2, pool_maxsize=LOOKUP_WORKERS))
+        _session = session
+  return _session
+
+class TokenManager:
+  """
+  Caches the client-credentials access token until shortly before it expires.
+  One instance is shared by every session / thread in the process.
+  """
+  def __init__(self, client_id, client_secret, token_url=TOKEN_URL, refresh_margin=60, clock=time.monotonic):
+    self.client_id = client_id
+    self.client_secret = client_secret
+    self.token_url = token_url
+    self.refresh_margin = refresh_margin # seconds before expiry to fetch a new token
+    self.clock = clock
+    self.refreshes = 0
+    self._token = None
+    self._expires_at = 0.0
+    self._lock = threading.Lock()
+
+  def _fetch(self):
+    body_params = {'grant_type' : 'client_credentials'}
+    start = time.perf_counter()
+    r = get_session().post(self.token_url, data=body_params, auth=(self.client_id, self.client_secret), timeout=REQUEST_TIMEOUT)
+    profiling.record_http('token', (time.perf_counter() - start) * 1000, r.status_code)
+    r.raise_for_status()
+
+    token_raw = r.json()
+    self._token = token_raw['access_token']
+    self._expires_at = self.clock() + float(token_raw.get('expires_in', 3600))
+    self.refreshes += 1
+
+  def token(self):
+    # the lock also makes sure only one thread refreshes, the others wait for its result
+    with self._lock:
+      if self._token is None or self.clock() >= self._expires_at - self.refresh_margin:
+        self._fetch()
+      return self._token
+
+  def invalidate(self):
+    with self._lock:
+      self._token = None
+      self._expires_at = 0.0
+
+class SpotifyError(Exception):
+  # spotify kept answering 429 / 5xx. retry_after is only set when it asked for a longer
+  # pause (Retry-After, seconds) than MAX_BACKOFF: the breaker then opens for that long
+  def __init__(self, message, retry_after=None):
+    super().__init__(message)
+    self.retry_after = retry_after
+
+class SpotifyUnavailable(Exception):
+  # the circuit breaker is open, the lookup was skipped without calling spotify
+  pass
+
+class CircuitBreaker:
+  """
+  Opens after `threshold` failures in a row (or straight away for a long Retry-After)
+  and rejects calls for `cooldown` seconds. Then one trial call is let through (half
+  open): if it succeeds the breaker closes, if it fails it opens again.
+  """
+  def __init__(self, threshold=BREAKER_FAILURES, cooldown=BREAKER_COOLDOWN, clock=time.monotonic):
+    self.threshold = threshold
+    self.cooldown = cooldown
+    self.clock = clock
+    self.state = 'closed'
+    self.failures = 0 # in a row
+    self.trips = 0
+    self._open_until = 0.0
+    self._trial = False # a half-open trial call is in flight
+    self._lock = threading.Lock()
+
+  def allow(self):
+    with self._lock:
+      if self.state == 'closed':
+        return True
+      if self.clock() < self._open_until or self._trial:
+        return False
+      self.state = 'half-open'
+      self._trial = True
+      return True
+
+  def success(self):
+    with self._lock:
+      self.state = 'closed'
+      self.failures = 0
+      self._trial = False
+
+  def failure(self, cooldown=None):
+    with self._lock:
+      self.failures += 1
+      self._trial = False
+      if self.state == 'half-open' or self.failures >= self.threshold or cooldown is not None:
+        self.state = 'open'
+        self._open_until = max(self._open_until, self.clock() + max(cooldown or 0, self.cooldown))
+        self.trips += 1
+
+class SpotifyClient:
+  """
+  Search calls with timeouts, 429 / 5xx retries with jittered backoff and a circuit
+  breaker, counting what happened for the debug panel. `api_url` and `tokens` can
+  point at a local fake server; `sleep` and the breaker's clock can be replaced.
+  """
+  def __init__(self, tokens, api_url=API_URL, breaker=None, max_retries=MAX_RETRIES, backoff_base=BACKOFF_BASE, max_backoff=MAX_BACKOFF, sleep=time.sleep):
+    self.tokens = tokens
+    self.api_url = api_url
+    self.breaker = breaker or CircuitBreaker()
+    self.max_retries = max_retries
+    self.backoff_base = backoff_base
+    self.max_backoff = max_backoff
+    self.sleep = sleep
+    self.counts = dict.fromkeys(['requests', 'ok', 'timeouts', 'errors', 'rate_limited', 'server_errors', 'retries', 'skipped'], 0)
+    self._lock = threading.Lock()
+
+  def _count(self, name):
+    with self._lock:
+      self.counts[name] += 1
+
+  def _backoff(self, attempt, retry_after):
+    # seconds to wait before retry `attempt` + 1, or None if spotify wants us to wait too long
+    delay = retry_after or 0.0
+    if delay > self.max_backoff:
+      return None
+    return min(delay + random.uniform(0, self.backoff_base * 2 ** attempt), self.max_backoff)
+
+  def _get(self, path, params, timeout):
+    refreshed = False
+    attempt = 0
+    while True:
+      start = time.perf_counter()
+      self._count('requests')
+      try:
+        headers = {
+          'Accept': 'application/json',
+          'Content-type': 'application/json',
+          'Authorization': f'Bearer {self.tokens.token()}'
+        }
+        r = get_session().get(f'{self.api_url}{path}', params=params, headers=headers, timeout=timeout)
+      except OSError as e: # requests' connection errors and timeouts are OSErrors
+        from requests import Timeout
+        self._count('timeouts' if isinstance(e, Timeout) else 'errors')
+        profiling.record_http('search', (time.perf_counter() - start) * 1000, type(e).__name__)
+        raise
+      profiling.record_http('search', (time.perf_counter() - start) * 1000, r.status_code)
+
+      if r.status_code == 401 and not refreshed:
+        self.tokens.invalidate() # token revoked / expired early, get a new one and retry once
+        refreshed = True
+        continue
+      if r.status_code == 429 or r.status_code >= 500:
+        self._count('rate_limited' if r.status_code == 429 else 'server_errors')
+        retry_after = _seconds(r.headers.get('Retry-After'))
+        wait = self._backoff(attempt, retry_after)
+        if wait is None: # longer than a page should wait, pause lookups instead
+          raise SpotifyError(f'spotify answered {r.status_code}, retry after {retry_after:.0f}s', retry_after)
+        if attempt == self.max_retries: # an ordinary failure, counts toward the breaker's threshold
+          raise SpotifyError(f'spotify answered {r.status_code}')
+        self._count('retries')
+        self.sleep(wait)
+        attempt += 1
+        continue
+      return r
+
+  def search_preview(self, query, timeout=REQUEST_TIMEOUT):
+    # the first matching track's preview url, or None if it has none
+    if not self.breaker.allow():
+      self._count('skipped')
+      raise SpotifyUnavailable('spotify lookups are paused after repeated failures')
+    try:
+      r = self._get('/search', {'q': query, 'type': 'track', 'limit': 1}, timeout)
+    except SpotifyError as e:
+      self.breaker.failure(e.retry_after)
+      raise
+    except Exception: # unreachable, timed out, or an unreadable token answer
+      self.breaker.failure()
+      raise
+    self.breaker.success() # spotify answered, even if it's an error about this query
+    r.raise_for_status()
+    self._count('ok')
+    items = r.json()['tracks']['items']
+    return items[0]['preview_url'] if items else None
+
+  def stats(self):
+    with self._lock:
+      return dict(self.counts, breaker=self.breaker.state, breaker_trips=self.breaker.trips)
+
+def _seconds(retry_after):
+  # Retry-After in seconds (spotify sends delta seconds), None if missing or an http date
+  try:
+    return max(float(retry_after), 0.0)
+  except (TypeError, ValueError):
+    return None
+
+token_manager = TokenManager(SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET)
+client = SpotifyClient(token_manager)
+preview_cache = PreviewCache()
+
+def get_spotify_token():
+  return token_manager.token()
+
+def spotify_stats():
+  return client.stats()
+
+def spotify_search(song, timeout=REQUEST_TIMEOUT):
+  # returns the track's preview url, or None if it has none; raises SpotifyUnavailable
+  # while the circuit breaker is open (cached answers are still served)
+  hit, preview_url = preview_cache.get(song)
+  if hit or OFFLINE:
+    return preview_url
+  preview_url = client.search_preview(song, timeout)
+  preview_cache.put(song, preview_url) # "no preview" answers are cached as well
+  return preview_url
+
+def _preview_or_none(query, timeout):
+  try:
+    return spotify_search(query, timeout=timeout)
+  except Exception:
+    return None
+
+def submit_previews(df, query='{song} {artist}', timeout=REQUEST_TIMEOUT):
+  """
+  Starts the preview url lookup of every row of a result frame on the worker pool
+  and returns their futures, in the same order as df. `query` is formatted with each
+  row's columns; a future's result is None where the lookup failed or the track
+  has no preview.
+  """
+  queries = [query.format(**row) for row in df.to_dict('records')]
+  # run each lookup in a copy of the caller's context so its http timings land in the caller's profile
+  return [_executor.submit(contextvars.copy_context().run, _preview_or_none, q, timeout) for q in queries]
+
+def search_previews(df, query='{song} {artist}', timeout=REQUEST_TIMEOUT):
+  # every row's preview url (or None) at once, waiting for all of the lookups
+  return [future.result() for future in submit_previews(df, query, timeout)]
+
+def preview_deadline(budget=PREVIEW_BUDGET):
+  # the time.monotonic() a page stops waiting for lookups started now
+  return time.monotonic() + budget
+
+def previews_as_completed(futures, deadline):
+  """
+  Yields (position, preview_url) of the lookups as they finish, until all are done
+  or the deadline (see preview_deadline) has passed. Lookups still running then are
+  not waited for; they finish in the background and fill the preview cache for the
+  next rerun.
+  """
+  positions = {future: position for position, future in enumerate(futures)}
+  try:
+    for future in as_completed(positions, timeout=max(deadline - time.monotonic(), 0)):
+      yield positions[future], future.result()
+  except TimeoutError:
+    return
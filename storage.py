@@ -0,0 +1,270 @@
+# where the track rows come from: sqlite (default) or a partitioned parquet export
+#
+# the query functions in utils.py ask a Storage for "these columns of the tracks
+# matching artist / years / feature ranges" and do the rest in pandas; each backend
+# pushes those filters down as far as it can.
+#
+#   SQLiteStorage   parameterized sql over the connection pool (db.py)
+#   ParquetStorage  acoustic_features exported to parquet, one directory per decade
+#                   sorted by artist inside, read through memory-mapped arrow with
+#                   column projection and predicate pushdown (years prune partitions,
+#                   artist / feature filters skip row groups by their statistics).
+#                   no row-by-row python conversion, and worker processes reading the
+#                   same files share the os page cache.
+#
+# $ python storage.py export billboard-200.db billboard-200.parquet
+# $ STORAGE_BACKEND=parquet streamlit run streamlit_app.py
+#
+# derived tables (decade_trends, album_summary, search indexes) always stay in sqlite.
+
+import os
+import sys
+import time
+import shutil
+import sqlite3
+import threading
+
+import numpy as np
+import pandas as pd
+
+from aggregates import mark_built, is_fresh
+from db import FEATURES, check_feature, check_sort_key
+from paging import PAGE_SIZE, keyset_sql, order_sql, page_positions, cursor
+
+# 'sqlite' or 'parquet'
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'sqlite')
+PARQUET_PATH = os.environ.get('PARQUET_PATH', './billboard-200.parquet')
+
+TRACK_COLUMNS = ('id', 'song', 'artist', 'album', 'date') + FEATURES
+ROW_GROUP_SIZE = 32768
+
+def check_column(name):
+  if name not in TRACK_COLUMNS:
+    raise ValueError(f'unknown column: {name!r}')
+  return name
+
+def year_bounds(years):
+  # [start, end] years -> half-open bounds on the 'YYYY-MM-DD' date strings:
+  # '1979-06-01' < '1980' but '1979-06-01' > '1979', so `date BETWEEN '1970' AND '1979'` missed 1979
+  start, end = years
+  return f'{start:04d}', f'{end + 1:04d}'
+
+class SQLiteStorage:
+  name = 'sqlite'
+
+  def __init__(self, pool):
+    self.pool = pool
+
+  def tracks(self, columns, artist=None, years=None, ranges=None):
+    """
+    `columns` of the tracks by `artist` released in the [start, end] `years` with every
+    feature in `ranges` ({name: (low, high)}) inside its range, in (date, id) order.
+    None means no filter. date comes back as datetime64.
+    """
+    where, params = [], []
+    if artist is not None:
+      where.append('artist = ?')
+      params.append(artist)
+    if years is not None:
+      where.append('date >= ? and date < ?')
+      params.extend(year_bounds(years))
+    for name, (low, high) in (ranges or {}).items():
+      where.append(f'{check_feature(name)} between ? and ?')
+      params.extend((low, high))
+
+    sql_query = f'select {", ".join(check_column(name) for name in columns)} from acoustic_features'
+    if where:
+      sql_query += ' where ' + ' and '.join(where)
+    df = self.pool.read_sql(sql_query + ' order by date, id', params)
+    if 'date' in df:
+      df['date'] = pd.to_datetime(df['date'], errors='coerce')
+    return df
+
+  def page(self, columns, artist=None, sort_by='date', descending=False, after=None, limit=PAGE_SIZE):
+    """
+    The first `limit` rows after cursor `after` in (sort_by, id) order (see paging.py),
+    as a frame of `columns` plus the (key, id) cursor of every row.
+    """
+    sort_by = check_sort_key(sort_by)
+    where, params = [], []
+    if artist is not None:
+      where.append('artist = ?')
+      params.append(artist)
+    keyset, keyset_params = keyset_sql(sort_by, descending, after)
+    if keyset:
+      where.append(keyset)
+      params.extend(keyset_params)
+
+    read = list(dict.fromkeys([check_column(name) for name in columns] + [sort_by, 'id']))
+    sql_query = f'select {", ".join(read)} from acoustic_features'
+    if where:
+      sql_query += ' where ' + ' and '.join(where)
+    df = self.pool.read_sql(f'{sql_query} {order_sql(sort_by, descending)} limit ?', params + [limit])
+    keys = [cursor(key, id) for key, id in zip(df[sort_by], df['id'])]
+    df = df[list(columns)]
+    if 'date' in df:
+      df = df.assign(date=pd.to_datetime(df['date'], errors='coerce'))
+    return df, keys
+
+  def count(self, artist=None):
+    if artist is None:
+      return self.pool.execute('select count(*) from acoustic_features')[0][0]
+    return self.pool.execute('select count(*) from acoustic_features where artist = ?', (artist,))[0][0]
+
+class ParquetStorage:
+  name = 'parquet'
+
+  def __init__(self, root):
+    import pyarrow.dataset as ds
+    from pyarrow import fs
+
+    self.root = root
+    self.dataset = ds.dataset(
+      root,
+      format='parquet',
+      partitioning='hive', # decade=1970/...
+      filesystem=fs.LocalFileSystem(use_mmap=True),
+    )
+
+  def tracks(self, columns, artist=None, years=None, ranges=None):
+    # same contract as SQLiteStorage.tracks
+    import pyarrow.dataset as ds
+
+    columns = [check_column(name) for name in columns]
+    conditions = []
+    if artist is not None:
+      conditions.append(ds.field('artist') == artist)
+    if years is not None:
+      start, end = years
+      conditions.append((ds.field('decade') >= start // 10 * 10) & (ds.field('decade') <= end // 10 * 10))
+      conditions.append((ds.field('year') >= start) & (ds.field('year') <= end))
+    for name, (low, high) in (ranges or {}).items():
+      conditions.append((ds.field(check_feature(name)) >= low) & (ds.field(name) <= high))
+
+    condition = None
+    for c in conditions:
+      condition = c if condition is None else condition & c
+
+    # fragments can come back in any order, so sort on the way out
+    read = list(dict.fromkeys(columns + ['date', 'id']))
+    df = self.dataset.to_table(columns=read, filter=condition).to_pandas()
+    df = df.sort_values(['date', 'id'], kind='mergesort', na_position='first').reset_index(drop=True)
+    return df[columns]
+
+  def page(self, columns, artist=None, sort_by='date', descending=False, after=None, limit=PAGE_SIZE):
+    # same contract as SQLiteStorage.page: the cursor and artist are pushed down,
+    # the matching rows' key columns are then ordered in numpy
+    import pyarrow.dataset as ds
+
+    sort_by = check_sort_key(sort_by)
+    condition = ds.field('artist') == artist if artist is not None else None
+    if after is not None:
+      key, id = after
+      field, ids = ds.field(sort_by), ds.field('id')
+      if descending:
+        later = field.is_null() & (ids < id) if key is None else (field < key) | (field == key) & (ids < id) | field.is_null()
+      else:
+        later = field.is_valid() | (ids > id) if key is None else (field > key) | (field == key) & (ids > id)
+      condition = later if condition is None else condition & later
+
+    read = list(dict.fromkeys([check_column(name) for name in columns] + [sort_by, 'id']))
+    df = self.dataset.to_table(columns=read, filter=condition).to_pandas()
+    keys, ids = df[sort_by].to_numpy(), df['id'].to_numpy()
+    positions = page_positions(keys, ids, descending, None, limit)
+    df = df.iloc[positions][list(columns)].reset_index(drop=True)
+    return df, [cursor(keys[i], ids[i]) for i in positions]
+
+  def count(self, artist=None):
+    import pyarrow.dataset as ds
+    return self.dataset.count_rows(filter=ds.field('artist') == artist if artist is not None else None)
+
+def export_parquet(db_path, root, chunk_rows=500000):
+  """
+  Writes acoustic_features to root/decade=<decade>/part-0.parquet (undated rows in
+  decade=-1), each file in (artist, date, id) order, and records the export in
+  derived_meta so a stale copy is noticed.
+  """
+  import pyarrow as pa
+  import pyarrow.parquet as pq
+
+  schema = pa.schema(
+    [('id', pa.int64()), ('song', pa.string()), ('artist', pa.string()), ('album', pa.string()), ('date', pa.timestamp('ns'))]
+    + [(name, pa.float64()) for name in FEATURES]
+    + [('year', pa.int16())]
+  )
+  tmp = root.rstrip('/') + '.tmp'
+  shutil.rmtree(tmp, ignore_errors=True)
+
+  conn = sqlite3.connect(db_path)
+  dated = "date glob '[0-9][0-9][0-9][0-9]*'"
+  decades = [row[0] for row in conn.execute(f'select distinct cast(substr(date, 1, 4) as integer) / 10 * 10 from acoustic_features where {dated} order by 1')]
+  select = f'select {", ".join(TRACK_COLUMNS)} from acoustic_features'
+  parts = [(-1, f'{select} where date is null or not {dated} order by artist, id', ())]
+  parts += [(decade, f'{select} where date >= ? and date < ? order by artist, date, id', year_bounds((decade, decade + 9))) for decade in decades]
+
+  # one decade at a time, streamed: sqlite does the sorting, memory stays at one chunk
+  total = 0
+  for decade, sql_query, params in parts:
+    cursor = conn.execute(sql_query, params)
+    writer = None
+    while True:
+      rows = cursor.fetchmany(chunk_rows)
+      if not rows:
+        break
+      df = pd.DataFrame(rows, columns=TRACK_COLUMNS)
+      df['date'] = pd.to_datetime(df['date'], errors='coerce')
+      df[list(FEATURES)] = df[list(FEATURES)].astype(float)
+      df['year'] = df['date'].dt.year.fillna(-1).astype(np.int16)
+      if writer is None:
+        os.makedirs(os.path.join(tmp, f'decade={decade}'))
+        writer = pq.ParquetWriter(os.path.join(tmp, f'decade={decade}', 'part-0.parquet'), schema)
+      writer.write_table(pa.Table.from_pandas(df, schema=schema, preserve_index=False), row_group_size=ROW_GROUP_SIZE)
+      total += len(df)
+      print(f'\rexported {total:,} rows', end='', flush=True)
+    if writer is not None:
+      writer.close()
+  print()
+
+  # swap the new export in, then drop the old one
+  if os.path.exists(root):
+    os.replace(root, root.rstrip('/') + '.old')
+  os.replace(tmp, root)
+  shutil.rmtree(root.rstrip('/') + '.old', ignore_errors=True)
+
+  with conn:
+    mark_built(conn, parquet_meta_name(root))
+  conn.close()
+  return total
+
+def parquet_meta_name(root):
+  return f'parquet:{os.path.abspath(root)}'
+
+_storages = {}
+_lock = threading.Lock()
+
+def get_storage(pool):
+  # one storage per database, picked by STORAGE_BACKEND. a missing or stale parquet
+  # export falls back to sqlite (re-run `python storage.py export` after an ingest)
+  key = pool.cache_key # a new data version re-checks the export
+  storage = _storages.get(key)
+  if storage is None:
+    with _lock:
+      storage = _storages.get(key)
+      if storage is None:
+        storage = SQLiteStorage(pool)
+        if STORAGE_BACKEND == 'parquet':
+          with pool.connection() as conn:
+            fresh = os.path.isdir(PARQUET_PATH) and is_fresh(conn, parquet_meta_name(PARQUET_PATH))
+          if fresh:
+            storage = ParquetStorage(PARQUET_PATH)
+          else:
+            print(f'{PARQUET_PATH} is missing or older than {pool.path}, reading from sqlite')
+        _storages[key] = storage
+  return storage
+
+if __name__ == '__main__':
+  if len(sys.argv) != 4 or sys.argv[1] != 'export':
+    sys.exit('usage: python storage.py export <db> <parquet dir>')
+  start = time.perf_counter()
+  n = export_parquet(sys.argv[2], sys.argv[3])
+  print(f'wrote {n:,} rows to {sys.argv[3]} in {time.perf_counter() - start:.1f}s')
@@ -1,21 +1,90 @@
 import streamlit as st
-import pandas as pd
-import altair as alt
-import sqlite3
-from sqlite3 import Connection
-import plotly.express as px
 
-from utils import *
+# altair / plotly / requests are imported by the sections that draw with them,
+# STARTUP_TIMING=1 reports what's left (see profiling.py)
+import profiling
+with profiling.startup_import('utils'):
+  from utils import *
+with profiling.startup_import('charts'):
+  from charts import CHART_FEATURES, scatter_data, bar_data, scatter_chart, album_bar_chart, comparison_chart, decade_box_chart, recommendation_chart
+from db import SORT_KEYS
+from paging import frame_page, n_pages
+from result_cache import mood_cache
 
 st.write(f'spotify client id: {SPOTIFY_CLIENT_ID}')
 
+def table_controls(key, columns, sort_keys, n_rows, sort_by='date', descending=False):
+  # column / sort / page pickers for a paged table, only the picked page is fetched and sent
+  left, middle, right = st.beta_columns(3)
+  shown = left.multiselect('columns', columns, columns, key=f'{key}-columns') or columns
+  sort_by = middle.selectbox('sort by', sort_keys, sort_keys.index(sort_by) if sort_by in sort_keys else 0, key=f'{key}-sort')
+  orders = ('ascending', 'descending')
+  descending = right.selectbox('order', orders, orders.index('descending' if descending else 'ascending'), key=f'{key}-order') == 'descending'
+  pages = n_pages(n_rows)
+  page = st.number_input(f'page (of {pages:,}, {n_rows:,} rows)', 1, pages, 1, key=f'{key}-page')
+  return list(shown), sort_by, descending, int(page) - 1
+
+def recommendation_html(song, details, track_id, preview_url=None):
+  # one recommended song: a link to its preview once that is known, plain text until then
+  name = f'<span id="song-name">{song}</span><span id="song-details"> - {details}</span>'
+  similar = f'<a class="small" href="?similar={track_id}" target="_self">more like this</a>'
+  if preview_url:
+    return f'<a class="rec-link" href="{preview_url}" target="_blank">{name}</a>\n{similar}'
+  return f'<div class="rec-link">{name}</div>\n{similar}'
+
 def main():
+  # time every stage of this rerun (see profiling.py)
+  profile = profiling.start()
+
   # use custom css
   with open('./styles.css') as f:
     st.markdown(f'<style>{f.read()}</style>', unsafe_allow_html=True)
 
-  db_conn = get_connection('./billboard-200.db') # connect to local db file
-  df = get_data(db_conn)
+  with profiling.stage('connection'):
+    db_conn = get_connection('./billboard-200.db') # connect to local db file
+
+  # sidebar - debug panel with this rerun's timings (DEBUG_PANEL=1 or ?debug=1)
+  show_timings = False
+  if profiling.DEBUG_PANEL or st.experimental_get_query_params().get('debug') == ['1']:
+    show_timings = st.sidebar.checkbox('show timings for this page')
+    timings_panel = st.sidebar.empty()
+  profile.detailed = show_timings
+
+  # sidebar - pick any artist to run the charts for (typeahead over the artist index)
+  st.sidebar.header('Explore another artist')
+  artist_text = st.sidebar.text_input('Search for an artist', '')
+  try:
+    with profiling.stage('search_artists'):
+      artists = search_artists(db_conn, artist_text, limit=20)['name'].tolist()
+  except Exception as e: # no artist index in this db
+    print(e)
+    artists = []
+  if not artist_text and DEFAULT_ARTIST in artists:
+    artists.remove(DEFAULT_ARTIST)
+  if not artist_text:
+    artists.insert(0, DEFAULT_ARTIST)
+  if artists:
+    artist = st.sidebar.selectbox('Artist', artists)
+  else:
+    st.sidebar.write('no artists found, showing David Bowie')
+    artist = DEFAULT_ARTIST
+
+  # sidebar - song / album lookup
+  track_text = st.sidebar.text_input('Find a song or album', '')
+  if track_text:
+    with profiling.stage('search_tracks'):
+      st.sidebar.dataframe(search_tracks(db_conn, track_text, limit=20)[['song', 'artist', 'album', 'date']])
+
+  # sidebar - "more like this" for a song clicked in the scatter chart or the recommendations
+  similar_to = st.experimental_get_query_params().get('similar', [''])[0]
+  if similar_to.isdigit():
+    with profiling.stage('similar_tracks'):
+      similar = get_similar_tracks(db_conn, int(similar_to))
+    st.sidebar.header('More like this')
+    if len(similar.index):
+      st.sidebar.dataframe(similar[['song', 'artist', 'album', 'score']])
+    else:
+      st.sidebar.write('no similar tracks found (they are built by `python similar.py`)')
 
   # title + intro
   # TODO: format title better
@@ -45,8 +114,10 @@ def main():
 
   #checkbox-original dataset
   if st.checkbox('show original dataset'):
-    st.text('original data set - accoustic features of songs of David Bowie from 1969-2018')
-    st.dataframe(df)
+    st.text(f'original data set - accoustic features of songs of {artist}')
+    # keyset pages sorted and projected by the backend, only the visible page is loaded
+    columns, sort_by, descending, page = table_controls('data', DATA_COLUMNS, list(SORT_KEYS), count_tracks(db_conn, artist), descending=True)
+    st.dataframe(get_data_page(db_conn, page, artist, columns, sort_by, descending))
     st.markdown("```SELECT * FROM EMP JOIN DEPT ON EMP.DEPTNO = DEPT.DEPTNO;```")
   
   #Paragraph-Intro to Features
@@ -64,112 +135,78 @@ def main():
   #select-feature
   option = st.selectbox(
   'Which acoustic feature do you want to explore?',
-  ('danceability', 'energy', 'instrumentalness'))
+  CHART_FEATURES)
 
   #connection config
-  all_dacade_avg = get_all_decade_avg(db_conn, option)
-  bowie_data = get_bowie_data(db_conn, option)
+  all_dacade_avg = get_all_decade_avg(db_conn, option, artist)
+  bowie_years = get_bowie_years(db_conn, option, artist)
+  bowie_data = bowie_years.frame
 
   #Paragrah-Chart 1
   st.markdown("<div id='charts'>", unsafe_allow_html=True)
-  st.header("Scatter Chart - David Bowie's albums")
+  st.header(f"Scatter Chart - {artist}'s albums")
   st.subheader(":musical_note: How does the selected feature shape the distribution of songs by album?")
   st.markdown("Instructions: The slider allows you to zoom in albums by year and clicking on the valence allows you to see the distribution of songs from high valence (happy) to low valence (sad).")
 
   #slider-year
   start_year = st.slider("Show me albums released within these years!", 1969, 2018, (1969,2000))
-  filtered_data1 = bowie_data[start_year[0] < bowie_data['date'].dt.year]
-  filtered_data2 = filtered_data1[filtered_data1['date'].dt.year <= start_year[1]]
-  select_scatter = alt.selection_multi(fields=['valence'], bind='legend') 
-
-  #color palette for scatter chart
-  range_ = ['#D64550', '#EE8189', '#FC8B4A','#F7B801','#B9F18C','#71DA1B','#439A86','#00BECC','#7678ED','#3D348B']
-
- 	#chart-scatter
-  scatter = alt.Chart(filtered_data2).mark_circle().encode(
-  alt.X('album',scale=alt.Scale(zero=True), sort={"field": "date", "order": "ascending"},title="Albums order by Issued Date"),
-  alt.Y(option,scale=alt.Scale(zero=True), title=option),
-  alt.Color('valence:O',
-    sort='descending',scale=alt.Scale(range=range_)),
-    tooltip=['album','song','date', option, 'valence', 'tempo'],
-    size=alt.Size('tempo',
-    scale=alt.Scale(domain=[0,100], range=[1,200]),
-    legend=alt.Legend(values=[50,100,150,200])),
-    opacity=alt.condition(select_scatter, alt.value(1), alt.value(0.1))
-  ).properties(
-    width=900,
-    height=900
-  ).add_selection(
-    select_scatter
-  )
-  st.write(scatter) # TODO: fix sizing of scatter chart
+  filtered_data = bowie_years.slice(*start_year)
+
+  #chart-scatter
+  with profiling.stage('chart/scatter') as timing:
+    points = scatter_data(filtered_data, option)
+    scatter = scatter_chart(points, option)
+    st.write(scatter) # TODO: fix sizing of scatter chart
+    timing.update(rows=len(points), bytes=profiling.payload_bytes(scatter))
+  if len(points) < len(filtered_data):
+    st.markdown(f"<span class='small'>showing a sample of {len(points):,} of {len(filtered_data):,} songs (the same share from every album)</span>", unsafe_allow_html=True)
 
   #checkbox-bowie's album
   if st.checkbox('show original dataset',key='album'):
     st.text('original data set - accoustic features of songs from 1969-2018')
-    st.dataframe(bowie_data)
+    columns, sort_by, descending, page = table_controls('album', list(bowie_data.columns), list(bowie_data.columns), len(bowie_data))
+    st.dataframe(frame_page(bowie_data, page, sort_by, descending, columns))
 
   #Paragrah-Chart 2
   st.markdown("<div id='comparison'>", unsafe_allow_html=True)
-  st.header("Bar Chart - David Bowie's albums with average features")
-  st.subheader(":musical_note: How do the acoustic features of Bowie's albums differ from other songs in that decade?")
+  st.header(f"Bar Chart - {artist}'s albums with average features")
+  st.subheader(f":musical_note: How do the acoustic features of {artist}'s albums differ from other songs in that decade?")
   st.markdown("Instructions: Click on the checkbox to compare with other songs from that decade. Click on the bar to highlight.")
 
-  #chart-bar
-  selector = alt.selection_single(empty='all', fields=['album'])    
-
-  # TODO: fix chart sizing
-  bar_album = alt.Chart(all_dacade_avg).mark_bar(color='#1FC3AA', opacity=0.5, thickness=10).encode(
-    alt.X('album',
-      sort={"field": "date", "order": "ascending"},
-      title="(B)Albums order by Issued Date"),
-    alt.Y('avg_feature',
-      scale=alt.Scale(zero=False),
-      title='(B)Average_'+ option +'_by_Albums'),
-      tooltip=['album', 'date', 'avg_feature'],
-      color=alt.condition(selector, 'album:O', alt.value('lightgray'), legend=None),
-  ).properties(
-    width=850,
-    height=600
-  ).add_selection(selector)
-
-  #chart-decade-the numbers
-  #chart-decade
-  bar_decade = alt.Chart(all_dacade_avg).mark_bar(color='#8624F5', opacity=0.5, thickness=10).encode(
-    alt.X('album',
-      sort={"field": "date", "order": "ascending"},
-      title="(V)The correspondent decade of albums Issued Date"),
-    alt.Y('trend_feature',
-      scale=alt.Scale(zero=False),
-      title='(V)Average_'+ option +'_by_Decade')
-	).properties(
-    width=850,
-    height=600
-  )#.add_selection(selector)
-  
-  #chart-decade-the numbers
-  text_decade = bar_decade.mark_text(align='center', color='white',dy=80).encode(
-    text='avg_feature:N'
-	)
-    
   #checkbox-chart comparison
   agree = st.checkbox('Compare the\n'+option+'\nof the albums with the average\n'+option+'\nof songs by decede.')
-  if agree:
-    st.write(bar_decade+bar_album+text_decade)
-  else:
-    st.write(bar_album)
+  with profiling.stage('chart/comparison') as timing:
+    albums = bar_data(all_dacade_avg)
+    if agree:
+      bars = comparison_chart(albums, option)
+    else:
+      bars = album_bar_chart(albums, option)
+    st.write(bars)
+    timing.update(rows=len(albums), bytes=profiling.payload_bytes(bars))
 
   agree = st.checkbox('show original dataset',key='decade')
   if agree:
-    st.text('David Bowie album average feature and all songs averge feature by decade')
-    st.dataframe(all_dacade_avg)
+    st.text(f'{artist} album average feature and all songs averge feature by decade')
+    columns, sort_by, descending, page = table_controls('decade', list(all_dacade_avg.columns), list(all_dacade_avg.columns), len(all_dacade_avg))
+    st.dataframe(frame_page(all_dacade_avg, page, sort_by, descending, columns))
+
+  # the decade average hides the spread, show each album against every song of its decade
+  if st.checkbox('show where each album sits among all songs of its decade', key='distribution'):
+    with profiling.stage('chart/decade_distribution') as timing:
+      album_ranks, boxes = get_decade_distribution(db_conn, option, albums)
+      if boxes is None:
+        st.write('no distribution sketches in this database yet (`python sketches.py billboard-200.db` builds them)')
+      else:
+        distribution = decade_box_chart(boxes, album_ranks, option)
+        st.write(distribution)
+        timing.update(rows=len(boxes) + len(album_ranks), bytes=profiling.payload_bytes(distribution))
 
   ################################################
   # music search
   st.markdown("<div id='search'>", unsafe_allow_html=True)
   st.header("Acoustic feature song search")
-  st.subheader(":musical_note: Which David Bowie songs fit my mood?")
-  st.markdown("Instructions: Follow the prompts and tune the sliders for energy, valence, danceability, and instrumentalness to find recommended David Bowie songs. Click on the recommended songs in the list to hear a 30-second preview of the track.")
+  st.subheader(f":musical_note: Which {artist} songs fit my mood?")
+  st.markdown(f"Instructions: Follow the prompts and tune the sliders for energy, valence, danceability, and instrumentalness to find recommended {artist} songs. Click on the recommended songs in the list to hear a 30-second preview of the track.")
 
   st.text("") # blank line for separation
   st.text("") # blank line for separation
@@ -181,10 +218,6 @@ def main():
     1963, 2019, (1970, 1979)
   )
 
-  # parse years as full dates for sql query purposes
-  for year_boundary in decades:
-    year_boundary = f'{year_boundary}/01/01'
-
   st.text("") # blank line for separation
   st.text("") # blank line for separation
   
@@ -214,63 +247,75 @@ def main():
   st.text("") # blank line for separation
   st.text("") # blank line for separation
 
+  # strict ranges can easily come back empty, closest matches always find something
+  search_mode = st.radio(
+    'How should we match your mood?',
+    ('only songs inside my ranges', 'the closest songs to the middle of my ranges')
+  )
+  mode = 'range' if search_mode.startswith('only') else 'nearest'
+  if mode == 'nearest':
+    st.markdown("<span class='small'>(closest matches are ranked by how close they are, the priority above is not used)</span>", unsafe_allow_html=True)
+  all_artists = st.checkbox(f'include songs by all artists, not just {artist}')
+
+  st.text("") # blank line for separation
+  st.text("") # blank line for separation
+
   # show results button
   # if st.button('show me my music!'):
-  sql_query = f"""
-    SELECT
-      song, artist, album, date, energy, valence, danceability
-    FROM 
-      acoustic_features
-    WHERE
-      (artist LIKE '%David Bowie%') AND
-      (date BETWEEN {decades[0]} AND {decades[1]}) AND
-      (energy BETWEEN {energy[0]} AND {energy[1]}) AND
-      (valence BETWEEN {valence[0]} AND {valence[1]}) AND
-      (danceability BETWEEN {danceability[0]} AND {danceability[1]})
-    ORDER BY {sort_by} DESC
-  """
-  df = pd.read_sql(sql_query, con=db_conn)
+  # repeated / popular slider positions come straight from the shared result cache
+  query = (db_conn, decades, energy, valence, danceability, sort_by, mode, None if all_artists else artist)
+  df = get_recommendations(*query)
 
   # check if there are any results
   if len(df.index) == 0:
     st.write('error: no songs were found with your constraints. please try again!')
   else:
-    df = remove_duplicates(df.head(10))
-
-    chart = px.bar(
-      df,
-      x='song',
-      y=['energy','valence','danceability'],
-      barmode='group',
-      height=500
-    )
+    # start the spotify preview lookups first, they run while the chart and list render,
+    # and the page stops waiting for them PREVIEW_BUDGET seconds from now
+    lookups = submit_previews(df)
+    deadline = preview_deadline()
 
-    st.plotly_chart(chart)
+    with profiling.stage('chart/recommendations') as timing:
+      chart = mood_cache.get_or_compute(mood_search_key(*query) + ('chart',), lambda: recommendation_chart(df))
+      st.plotly_chart(chart)
+      timing.update(rows=len(df), bytes=profiling.payload_bytes(chart))
 
     st.markdown("<br>Your top recommendations:<br>", unsafe_allow_html=True)
-    for row in df.values:
+
+    # every song is shown right away without a link, then turned into one as its preview comes in
+    items = []
+    for row, track_id in zip(df.values, df['id']):
       song = row[0]
       album = row[2]
       date = row[3]
       if '-' in date:
         date = date.split('-')[0]
-
-      try:
-        # get spotify preview
-        preview_url = spotify_search(f'{song} david bowie')
-
-        st.markdown(f'''
-          <a class="rec-link" href="{preview_url}" target="_blank">
-            <span id="song-name">{song}</span><span id="song-details"> - {album} ({date})</span>
-          </a>
-        ''', unsafe_allow_html=True)
-      except Exception:
-        st.markdown(f'''
-          <div class="rec-link">
-            <span id="song-name">{song}</span><span id="song-details"> - {album} ({date})</span>
-          </div>
-        ''', unsafe_allow_html=True)
-
-
+      if all_artists:
+        album = f'{row[1]}, {album}'
+      details = f'{album} ({date})'
+      placeholder = st.empty()
+      placeholder.markdown(recommendation_html(song, details, track_id), unsafe_allow_html=True)
+      items.append((placeholder, song, details, track_id))
+
+    # songs whose lookup is still running at the deadline stay plain
+    with profiling.stage('spotify_previews') as timing:
+      found = 0
+      for position, preview_url in previews_as_completed(lookups, deadline):
+        if preview_url:
+          placeholder, song, details, track_id = items[position]
+          placeholder.markdown(recommendation_html(song, details, track_id, preview_url), unsafe_allow_html=True)
+          found += 1
+      timing['rows'] = found
+
+  profile.finish()
+  if show_timings:
+    timings_panel.table(profile.frame())
+    st.sidebar.write(f'total: {profile.total_ms:.0f} ms')
+    stats = mood_cache.stats()
+    st.sidebar.write(f"mood search cache: {stats['hit_rate']:.0%} hits ({stats['hits']:,} / {stats['hits'] + stats['misses']:,}), {stats['entries']:,} entries, {stats['bytes'] / 1e6:.1f} MB, {stats['evictions']:,} evicted")
+    spotify = spotify_stats()
+    st.sidebar.write(f"spotify: {spotify['ok']:,} ok / {spotify['requests']:,} requests, {spotify['timeouts']:,} timeouts, {spotify['errors']:,} errors, {spotify['rate_limited']:,} rate limited, {spotify['server_errors']:,} 5xx, {spotify['retries']:,} retries, {spotify['skipped']:,} skipped, breaker {spotify['breaker']} ({spotify['breaker_trips']:,} trips)")
+  profiling.write_log(profile)
+  profiling.report_startup(profile)
 
 main()
@@ -0,0 +1,217 @@
+# spotify client tests against a local fake http server
+#
+# $ python -m pytest test_spotify.py
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+import spotify
+
+class FakeSpotify:
+  """
+  Local stand-in for the token endpoint and /search. `answers` is a list of
+  (status, headers, delay) the next searches get, after that they get a preview.
+  Tokens are token-1, token-2, ... and last `expires_in` seconds.
+  """
+  def __init__(self, expires_in=3600):
+    self.answers = []
+    self.searches = 0
+    self.tokens = 0
+    self.expires_in = expires_in
+    self.authorizations = [] # Authorization header of every search
+    fake = self
+
+    class Handler(BaseHTTPRequestHandler):
+      def log_message(self, *args):
+        pass
+
+      def _send(self, status, body, headers=()):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        for name, value in headers:
+          self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+      def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        fake.tokens += 1
+        self._send(200, {'access_token': f'token-{fake.tokens}', 'expires_in': fake.expires_in})
+
+      def do_GET(self):
+        fake.searches += 1
+        fake.authorizations.append(self.headers.get('Authorization'))
+        status, headers, delay = fake.answers.pop(0) if fake.answers else (200, (), 0)
+        time.sleep(delay)
+        body = {'tracks': {'items': [{'preview_url': 'https://p.scdn.co/preview'}]}} if status == 200 else {}
+        self._send(status, body, headers)
+
+    self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+    threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+  def close(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+class Clock:
+  def __init__(self):
+    self.now = 0.0
+
+  def __call__(self):
+    return self.now
+
+@pytest.fixture
+def fake():
+  server = FakeSpotify()
+  yield server
+  server.close()
+
+@pytest.fixture
+def clock():
+  return Clock()
+
+def make_client(fake, clock, sleeps, threshold=3, cooldown=30):
+  tokens = spotify.TokenManager('id', 'secret', token_url=fake.url + '/token')
+  breaker = spotify.CircuitBreaker(threshold=threshold, cooldown=cooldown, clock=clock)
+  return spotify.SpotifyClient(tokens, api_url=fake.url, breaker=breaker, sleep=sleeps.append)
+
+def test_retries_429_then_503_then_ok(fake, clock):
+  sleeps = []
+  client = make_client(fake, clock, sleeps)
+  fake.answers = [(429, [('Retry-After', '1')], 0), (503, (), 0)]
+
+  assert client.search_preview('heroes') == 'https://p.scdn.co/preview'
+  assert fake.searches == 3
+  assert 1.0 <= sleeps[0] <= spotify.MAX_BACKOFF # Retry-After plus jitter
+  assert 0.0 <= sleeps[1] <= 2 * spotify.BACKOFF_BASE # exponential backoff, second attempt
+  stats = client.stats()
+  assert (stats['rate_limited'], stats['server_errors'], stats['retries'], stats['ok']) == (1, 1, 2, 1)
+  assert stats['breaker'] == 'closed'
+
+def test_short_retry_after_counts_toward_threshold(fake, clock):
+  sleeps = []
+  client = make_client(fake, clock, sleeps, threshold=3)
+  fake.answers = [(429, [('Retry-After', '0')], 0)] * 3
+
+  with pytest.raises(spotify.SpotifyError):
+    client.search_preview('heroes')
+  assert len(sleeps) == spotify.MAX_RETRIES
+  assert client.breaker.state == 'closed' # one failure, not an open breaker
+  assert client.breaker.failures == 1
+
+def test_long_retry_after_opens_breaker(fake, clock):
+  sleeps = []
+  client = make_client(fake, clock, sleeps)
+  fake.answers = [(429, [('Retry-After', '120')], 0)]
+
+  with pytest.raises(spotify.SpotifyError) as error:
+    client.search_preview('heroes')
+  assert error.value.retry_after == 120
+  assert sleeps == [] # not waited for
+  assert client.breaker.state == 'open'
+
+  with pytest.raises(spotify.SpotifyUnavailable):
+    client.search_preview('heroes')
+  assert fake.searches == 1
+  assert client.stats()['skipped'] == 1
+
+  clock.now = 100 # past the 30s cool-down, but not the Retry-After
+  assert not client.breaker.allow()
+  clock.now = 121
+  assert client.search_preview('heroes') == 'https://p.scdn.co/preview'
+  assert client.breaker.state == 'closed'
+
+def test_half_open_trial(fake, clock):
+  sleeps = []
+  client = make_client(fake, clock, sleeps, threshold=3, cooldown=30)
+  for _ in range(3):
+    fake.answers = [(500, (), 0)] * (spotify.MAX_RETRIES + 1)
+    with pytest.raises(spotify.SpotifyError):
+      client.search_preview('heroes')
+  assert client.breaker.state == 'open'
+  assert client.breaker.trips == 1
+
+  clock.now = 31
+  assert client.breaker.allow() # the one trial call
+  assert client.breaker.state == 'half-open'
+  assert not client.breaker.allow() # everyone else waits for its result
+  client.breaker.failure()
+  assert client.breaker.state == 'open' # failed trial: another cool-down
+  assert client.breaker.trips == 2
+
+  clock.now = 62
+  assert client.search_preview('heroes') == 'https://p.scdn.co/preview'
+  assert client.breaker.state == 'closed'
+  assert client.breaker.failures == 0
+
+def test_read_timeout(fake, clock):
+  sleeps = []
+  client = make_client(fake, clock, sleeps)
+  fake.answers = [(200, (), 1.0)]
+
+  start = time.perf_counter()
+  with pytest.raises(requests.Timeout):
+    client.search_preview('heroes', timeout=(1, 0.2))
+  assert time.perf_counter() - start < 0.9
+  assert client.stats()['timeouts'] == 1
+  assert client.breaker.failures == 1
+
+def test_client_errors_dont_trip_breaker(fake, clock):
+  sleeps = []
+  client = make_client(fake, clock, sleeps, threshold=2)
+  fake.answers = [(400, (), 0)] * 3
+  for _ in range(3):
+    with pytest.raises(requests.HTTPError):
+      client.search_preview('heroes')
+  assert client.breaker.state == 'closed'
+  assert fake.searches == 3
+
+def test_token_is_cached(fake, clock):
+  tokens = spotify.TokenManager('id', 'secret', token_url=fake.url + '/token', clock=clock)
+  assert tokens.token() == 'token-1'
+  clock.now = 1000
+  assert tokens.token() == 'token-1'
+  assert fake.tokens == 1
+
+def test_token_is_fetched_once_by_concurrent_threads(fake, clock):
+  tokens = spotify.TokenManager('id', 'secret', token_url=fake.url + '/token', clock=clock)
+  results = []
+  threads = [threading.Thread(target=lambda: results.append(tokens.token())) for _ in range(8)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  assert results == ['token-1'] * 8
+  assert fake.tokens == 1
+
+def test_token_refreshes_within_margin(fake, clock):
+  fake.expires_in = 600
+  tokens = spotify.TokenManager('id', 'secret', token_url=fake.url + '/token', refresh_margin=60, clock=clock)
+  assert tokens.token() == 'token-1'
+  clock.now = 539 # 61s left
+  assert tokens.token() == 'token-1'
+  clock.now = 540 # inside the margin
+  assert tokens.token() == 'token-2'
+  assert tokens.refreshes == 2
+
+def test_token_invalidated_after_401(fake, clock):
+  tokens = spotify.TokenManager('id', 'secret', token_url=fake.url + '/token', clock=clock)
+  client = spotify.SpotifyClient(tokens, api_url=fake.url, breaker=spotify.CircuitBreaker(clock=clock), sleep=[].append)
+  fake.answers = [(401, (), 0)]
+
+  assert client.search_preview('heroes') == 'https://p.scdn.co/preview'
+  assert fake.authorizations == ['Bearer token-1', 'Bearer token-2']
+  assert fake.tokens == 2
+
+  fake.answers = [(401, (), 0)] * 2 # a new token doesn't help: only retried once
+  with pytest.raises(requests.HTTPError):
+    client.search_preview('heroes')
+  assert fake.tokens == 3
@@ -0,0 +1,81 @@
+# query layer tests on a small generated database
+#
+# $ python -m pytest test_utils.py
+
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+pytest.importorskip('streamlit')
+
+import utils
+import feature_store
+from db import ConnectionPool, data_version
+
+ARTIST = 'David Bowie'
+
+@pytest.fixture
+def pool(tmp_path):
+  # 30 tracks over three albums, every third one without a valence
+  path = tmp_path / 'billboard-200.db'
+  conn = sqlite3.connect(path)
+  conn.execute('''
+    create table acoustic_features (
+      id integer, song text, album_id integer, album text, artist text, danceability real,
+      energy real, instrumentalness real, valence real, tempo real, date text
+    )
+  ''')
+  rows = [
+    (i, f'song {i}', i % 3, f'album {i % 3}', ARTIST, 0.5, i / 30, 0.0, None if i % 3 == 0 else i / 31, 100.0 + i, f'197{i % 10}-01-01')
+    for i in range(30)
+  ]
+  conn.executemany('insert into acoustic_features values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+  conn.commit()
+  conn.close()
+  pool = ConnectionPool(str(path))
+  yield pool
+  pool.close()
+
+@pytest.mark.parametrize('use_store', [False, True])
+def test_bowie_data_keeps_null_valence(pool, use_store, monkeypatch):
+  monkeypatch.setattr(utils, 'USE_FEATURE_STORE', use_store)
+  if use_store:
+    feature_store.get_feature_store(pool) # loaded, so get_bowie_data reads from it
+  df = utils.get_bowie_data(pool, 'energy', ARTIST).sort_values('id')
+
+  assert len(df) == 30
+  missing = df['id'] % 3 == 0
+  assert df.loc[missing, 'valence'].isna().all()
+  # the rest is cast(valence * 10 as int), as the sql this replaced
+  expected = np.trunc(df.loc[~missing, 'id'] / 31 * 10).astype(int)
+  assert (df.loc[~missing, 'valence'].astype(int) == expected).all()
+
+def test_prepare_runs_in_background_once_per_database(pool, monkeypatch):
+  started, release = threading.Event(), threading.Event()
+  rounds = []
+  def slow_prepare(pool):
+    rounds.append(pool.path)
+    started.set()
+    release.wait(5)
+  monkeypatch.setattr(utils, '_prepare', slow_prepare)
+
+  utils._start_prepare(pool) # returns before the build is done
+  assert started.wait(5)
+  utils._start_prepare(pool) # the data changed during the build: one more round
+  utils._start_prepare(pool)
+  release.set()
+  deadline = time.monotonic() + 5
+  while pool.path in utils._preparing and time.monotonic() < deadline:
+    time.sleep(0.01)
+
+  assert pool.path not in utils._preparing
+  assert rounds == [pool.path, pool.path]
+
+def test_data_version_of_relative_path(pool, monkeypatch):
+  path = Path(pool.path)
+  monkeypatch.chdir(path.parent)
+  assert data_version(path.name) == data_version(pool.path) != ''
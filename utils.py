@@ -1,111 +1,317 @@
 import os
+import threading
 import streamlit as st
 import pandas as pd
-import altair as alt
-import sqlite3
-from sqlite3 import Connection
-import requests
-import json
-import plotly.express as px
-
-# spotify stuff
-SPOTIFY_CLIENT_ID = os.environ.get('SPOTIFY_CLIENT_ID')
-SPOTIFY_CLIENT_SECRET = os.environ.get('SPOTIFY_CLIENT_SECRET')
-
-def get_spotify_token():
-  url='https://accounts.spotify.com/api/token'
-  grant_type = 'client_credentials'
-  body_params = {'grant_type' : grant_type}
-
-  r = requests.post(url, data=body_params, auth = (SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET))
-  r.raise_for_status()
-
-  token_raw = json.loads(r.text)
-  token = token_raw["access_token"]
-
-  return token
-
-def spotify_search(song):
-  token = get_spotify_token()
-  url = f'https://api.spotify.com/v1/search?q={song}&type=track&limit=1'
-  headers = {
-    'Accept': 'application/json',
-    'Content-type': 'application/json',
-    'Authorization': f'Bearer {token}'
-  }
-
-  r = requests.get(url, headers=headers)
-  r.raise_for_status()
-
-  if r.status_code == 200:
-    data = r.json()
-    result = data['tracks']['items'][0]
-    thirty_sec_preview_url = result['preview_url']
-    return thirty_sec_preview_url
-  else:
-    raise Exception('Failed to get Spotify data.')
+import numpy as np
 
-@st.cache(hash_funcs={Connection: id})  # add caching so we load the data only once
-def get_connection(path_to_db):
-  # connect to db
+import profiling
+from aggregates import ensure_decade_trends, ensure_album_summary
+from sketches import ensure_histograms, load_histograms, merge, percentile_rank, quantiles
+from db import ConnectionPool, check_feature, check_sort_key, has_table
+from feature_store import YearSlicer, get_feature_store
+from storage import get_storage, year_bounds
+from paging import PAGE_SIZE, get_pager
+from result_cache import mood_cache, quantize, dequantize
+from mood_index import get_mood_index, mood_distance
+from search import ensure_search_index, search_artists, search_tracks, search_albums
+from spotify import SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET, get_spotify_token, spotify_search, spotify_stats, search_previews, submit_previews, preview_deadline, previews_as_completed
+
+# answer the query functions below from the shared in-memory feature store
+# (set FEATURE_STORE=0 to always go to the storage backend instead, see storage.py)
+USE_FEATURE_STORE = os.environ.get('FEATURE_STORE', '1') != '0'
+
+def _loaded_store(conn: ConnectionPool):
+  # the feature store loads in the background on first use; sqlite answers until it's ready
+  return get_feature_store(conn, wait=False) if USE_FEATURE_STORE else None
+
+DEFAULT_ARTIST = 'David Bowie'
+DATA_COLUMNS = ['song', 'artist', 'album', 'date', 'energy', 'valence', 'danceability', 'instrumentalness', 'tempo']
+
+def _prepare(pool: ConnectionPool):
+  # build / refresh the precomputed decade averages and search indexes for this version of the file
   try:
-    conn = sqlite3.connect(path_to_db, check_same_thread=False)
-    return conn
+    with pool.writer() as conn:
+      ensure_decade_trends(conn)
+      ensure_album_summary(conn)
+      ensure_histograms(conn)
+      ensure_search_index(conn)
   except Exception as e:
     print(e)
+  # the builds above don't change the data version (see db.data_version)
+  _loaded_store(pool) # start loading the feature store now, without waiting for it
 
-def get_data(conn: Connection):
-  sql_query = """
-  SELECT 
-    song, artist, album, date, energy, valence, danceability, instrumentalness, tempo
-  FROM 
-    acoustic_features 
-  WHERE 
-    artist LIKE '%David Bowie%'
-  ORDER BY date DESC
-  """
-  df = pd.read_sql(sql_query, con=conn)
-  df['date'] = pd.to_datetime(df['date'])
+_preparing = {} # path -> whether another round was asked for while a build runs
+_preparing_lock = threading.Lock()
+
+def _prepare_in_background(pool: ConnectionPool):
+  again = True
+  while again:
+    try:
+      _prepare(pool)
+    except Exception as e:
+      print(e)
+    with _preparing_lock:
+      again = _preparing.pop(pool.path)
+      if again: # the data changed again during the build
+        _preparing[pool.path] = False
+
+def _start_prepare(pool: ConnectionPool):
+  # the builds take seconds on the full table, so they run on a background thread instead of
+  # before the first render; until they're done the readers fall back (see has_table below).
+  # one build per database at a time, a change during it gets one more round afterwards
+  with _preparing_lock:
+    if pool.path in _preparing:
+      _preparing[pool.path] = True
+      return
+    _preparing[pool.path] = False
+  threading.Thread(target=_prepare_in_background, args=(pool,), name='prepare', daemon=True).start()
+
+@st.cache(allow_output_mutation=True)  # add caching so we load the data only once
+def _open_pool(path_to_db):
+  # shared pool of read-only connections, see db.py
+  try:
+    pool = ConnectionPool(path_to_db)
+  except Exception as e:
+    print(e)
+    return None
+  _start_prepare(pool)
+  return pool
+
+def get_connection(path_to_db):
+  # every rerun checks whether the database changed (ingest, or a new file copied over it).
+  # all cached results are keyed on pool.cache_key, so only results from the old
+  # version stop being used; nothing else has to be cleared.
+  pool = _open_pool(path_to_db)
+  if pool is not None:
+    old_key = pool.cache_key
+    if pool.refresh():
+      _start_prepare(pool)
+      mood_cache.discard(lambda key: key[0] == old_key) # free the memory right away
+  return pool
+
+@profiling.timed
+def get_data(conn: ConnectionPool, artist=DEFAULT_ARTIST):
+  store = _loaded_store(conn)
+  if store is not None:
+    mask = store.equals('artist', artist)
+    df = store.select(DATA_COLUMNS, mask)
+    return df.iloc[::-1].reset_index(drop=True) # store is in date order, we want newest first
+
+  df = get_storage(conn).tracks(DATA_COLUMNS, artist=artist)
+  return df.iloc[::-1].reset_index(drop=True)
+
+@profiling.timed
+def get_data_page(conn: ConnectionPool, page, artist=DEFAULT_ARTIST, columns=DATA_COLUMNS, sort_by='date', descending=True, page_size=PAGE_SIZE):
+  # one page of get_data, sorted and projected by the backend (keyset pagination, see paging.py)
+  sort_by = check_sort_key(sort_by)
+  store = _loaded_store(conn)
+  source = store if store is not None else get_storage(conn)
+  return get_pager(conn.cache_key, source, artist, sort_by, descending, page_size).page(page, columns)
+
+@st.cache(hash_funcs={ConnectionPool: lambda pool: pool.cache_key})
+def count_tracks(conn: ConnectionPool, artist=DEFAULT_ARTIST):
+  store = _loaded_store(conn)
+  return (store if store is not None else get_storage(conn)).count(artist)
+
+@profiling.timed
+def get_bowie_data(conn: ConnectionPool,feature, artist=DEFAULT_ARTIST):
+  feature = check_feature(feature)
+  columns = ['song', 'tempo', feature, 'valence', 'date', 'album', 'id']
+  store = _loaded_store(conn)
+  if store is not None:
+    df = store.select(columns, store.equals('artist', artist))
+  else:
+    df = get_storage(conn).tracks(columns, artist=artist)
+  df[feature] = round_half_up(df[feature])
+  df['valence'] = np.trunc(df['valence'] * 10).astype('Int64') # same as cast(valence*10 as int), NULL stays NA
+  return df
+
+@st.cache(hash_funcs={ConnectionPool: lambda pool: pool.cache_key}, allow_output_mutation=True)
+def get_bowie_years(conn: ConnectionPool, feature, artist=DEFAULT_ARTIST):
+  # get_bowie_data sorted by date once, so the year slider is a binary search (see YearSlicer).
+  # shared between sessions: slice it, don't modify it
+  return YearSlicer(get_bowie_data(conn, feature, artist))
+
+def round_half_up(values, digits=2):
+  # sqlite's round() goes half away from zero, pandas/numpy round half to even
+  scale = 10 ** digits
+  return np.sign(values) * np.floor(np.abs(values) * scale + 0.5 + 1e-9) / scale
+
+def _album_averages(conn, feature, by, artist):
+  # per-album mean of one feature over the artist's rows, when there's no album_summary table
+  columns = ['album', 'date', feature]
+  store = _loaded_store(conn)
+  if store is not None:
+    df = store.select(columns, store.equals('artist', artist)) # in date order
+  else:
+    df = get_storage(conn).tracks(columns, artist=artist)
+  df['date'] = df['date'].dt.strftime('%Y-%m-%d')
+  aggs = {'date': ('date', 'first'), 'avg_feature': (feature, 'mean')}
+  aggs = {name: agg for name, agg in aggs.items() if name not in by}
+  df = df.groupby(by, sort=True).agg(**aggs).reset_index()
+  df['avg_feature'] = round_half_up(df['avg_feature'])
   return df
 
-def get_bowie_data(conn: Connection,feature):
-    df = pd.read_sql(f'select song, tempo,round({feature},2) as {feature},cast(valence*10 as int) as valence,date,album from acoustic_features where artist="David Bowie"', con=conn)
-    df['date'] = pd.to_datetime(df['date'])
+@profiling.timed
+def get_album_summary(conn: ConnectionPool, artist=DEFAULT_ARTIST, feature=None):
+  # precomputed per-release statistics (n, mean, median, min, max, std, q25, q75, see
+  # aggregates.py) for one artist, for every feature or just one
+  if feature is not None:
+    return conn.read_sql('select * from album_summary where artist = ? and feature = ? order by date, album', (artist, check_feature(feature)))
+  return conn.read_sql('select * from album_summary where artist = ? order by date, album, feature', (artist,))
+
+@profiling.timed
+def get_feature_avg(conn: ConnectionPool,feature, artist=DEFAULT_ARTIST):
+  # one row per album: its first release date and the mean of the feature over all its tracks
+  feature = check_feature(feature)
+  if has_table(conn, 'album_summary'):
+    sql_query = 'select min(date) as date, album, round(sum(mean * n) / sum(n), 2) as avg_feature from album_summary where artist = ? and feature = ? group by album'
+    return conn.read_sql(sql_query, (artist, feature))
+
+  df = _album_averages(conn, feature, ['album'], artist)
+  return df[['date', 'album', 'avg_feature']]
+
+@profiling.timed
+def get_all_decade_avg(conn: ConnectionPool,feature, artist=DEFAULT_ARTIST):
+  feature = check_feature(feature)
+  # the decade trend comes from the small precomputed decade_trends table (see aggregates.py)
+  # instead of a full scan of acoustic_features on every rerun
+  if has_table(conn, 'decade_trends'):
+    trend = f'select ten_year_group, round({feature},2) trend_feature from decade_trends'
+  else:
+    trend = f'select substr(date, 1, 4) / 10 as ten_year_group, round(avg({feature}),2) trend_feature from acoustic_features group by 1'
+
+  if has_table(conn, 'album_summary'):
+    # a handful of precomputed rows per artist instead of aggregating their tracks
+    sql_query = f'''
+      select
+        s.album, s.date, substr(s.date, 1, 4) as year, substr(s.date, 1, 4) / 10 as ten_year_group,
+        round(s.mean, 2) as avg_feature, trend.trend_feature
+      from album_summary s
+      left join ({trend}) as trend on trend.ten_year_group = substr(s.date, 1, 4) / 10
+      where s.artist = ? and s.feature = ?
+      order by s.album, s.date
+    '''
+    return conn.read_sql(sql_query, (artist, feature))
+
+  df = _album_averages(conn, feature, ['album', 'date'], artist)
+  df['year'] = df['date'].str[:4]
+  df['ten_year_group'] = pd.to_numeric(df['year'], errors='coerce') // 10
+  df = df[['album', 'date', 'year', 'ten_year_group', 'avg_feature']]
+  #new_df_by_melt = pd.melt(df, id_vars=['year'], value_vars=['energy', 'danceability', 'instrumentalness', 'valence'], var_name='attr')
+  return df.merge(conn.read_sql(trend), on='ten_year_group', how='left')
+
+@st.cache(hash_funcs={ConnectionPool: lambda pool: pool.cache_key}, allow_output_mutation=True)
+def get_histograms(conn: ConnectionPool):
+  # per-year feature histograms (see sketches.py), a few hundred KB kept per data version
+  return load_histograms(conn) if has_table(conn, 'feature_histograms') else {}
+
+@profiling.timed
+def get_decade_distribution(conn: ConnectionPool, feature, albums):
+  """
+  Where each album of `albums` (one row per album with date and avg_feature) sits within
+  everything released in its decade, read off the histograms instead of the tracks:
+  returns (albums + decade / decade_percentile, one row of box plot quantiles per
+  decade), or (None, None) without histograms.
+  """
+  histograms = get_histograms(conn)
+  if check_feature(feature) not in histograms:
+    return None, None
+  albums = albums.assign(decade=pd.to_numeric(albums['date'].str[:4], errors='coerce') // 10 * 10)
+  albums = albums.dropna(subset=['decade']).astype({'decade': int})
+
+  boxes, ranks = [], {}
+  for decade in sorted(albums['decade'].unique()):
+    counts = merge(histograms, feature, decade, decade + 9)
+    p05, q25, median, q75, p95 = quantiles(counts, feature, (0.05, 0.25, 0.5, 0.75, 0.95))
+    boxes.append({'decade': f'{decade}s', 'n': int(counts.sum()), 'p05': p05, 'q25': q25, 'median': median, 'q75': q75, 'p95': p95})
+    ranks[decade] = counts
+
+  albums['decade_percentile'] = [round(percentile_rank(ranks[decade], feature, value), 1) for decade, value in zip(albums['decade'], albums['avg_feature'])]
+  albums['decade'] = albums['decade'].astype(str) + 's'
+  return albums, pd.DataFrame(boxes).round(3)
+
+@profiling.timed
+def search_songs(conn: ConnectionPool, decades, energy, valence, danceability, sort_by, mode='range', artist=DEFAULT_ARTIST, k=50):
+  # "which songs fit my mood?" search, over one artist or everyone (artist=None)
+  #   mode='range':   songs inside every slider range, sorted by `sort_by`
+  #   mode='nearest': the k songs closest to the middle of the ranges, closest first
+  sort_by = check_sort_key(sort_by)
+  columns = ['song', 'artist', 'album', 'date', 'energy', 'valence', 'danceability', 'id']
+  bounds = {'energy': energy, 'valence': valence, 'danceability': danceability}
+  target = {name: (low + high) / 2 for name, (low, high) in bounds.items()}
+
+  store = _loaded_store(conn)
+  if store is not None:
+    index = get_mood_index(store)
+    mask = store.years(decades[0], decades[1])
+    if artist is not None:
+      mask &= store.equals('artist', artist)
+
+    if mode == 'nearest':
+      rows, distances = index.nearest(target, k, mask)
+      df = store.select(columns, rows)
+      df['distance'] = distances
+    else:
+      df = store.select(columns, index.within(bounds, mask))
+      df = df.sort_values(sort_by, ascending=False, kind='mergesort').reset_index(drop=True)
+    df['date'] = df['date'].dt.strftime('%Y-%m-%d')
     return df
 
-def get_feature_avg(conn: Connection,feature):
-	df = pd.read_sql(f'select song, date, album, round(avg({feature}),2) as avg_feature from acoustic_features where artist="David Bowie" group by album', con=conn)
-	return df
+  storage = get_storage(conn)
+  if mode == 'nearest':
+    # no spatial index in the storage backends, rank the candidates for the artist / years in pandas
+    df = storage.tracks(columns, artist=artist, years=decades)
+    df['distance'] = mood_distance(df, target)
+    df = df.dropna(subset=['distance']) # tracks missing a mood feature, as in MoodIndex
+    df = df.nsmallest(k, 'distance').reset_index(drop=True)
+  else:
+    df = storage.tracks(columns, artist=artist, years=decades, ranges=bounds)
+    df = df.sort_values(sort_by, ascending=False, kind='mergesort').reset_index(drop=True)
+  df['date'] = df['date'].dt.strftime('%Y-%m-%d')
+  return df
+
+def mood_search_key(conn: ConnectionPool, decades, energy, valence, danceability, sort_by, mode='range', artist=DEFAULT_ARTIST):
+  # normalized search: bounds in whole slider steps, and nearest mode ignores sort_by
+  sort_by = check_sort_key(sort_by) if mode == 'range' else None
+  return (conn.cache_key, tuple(decades), quantize(energy), quantize(valence), quantize(danceability), sort_by, mode, artist)
 
-def get_all_decade_avg(conn: Connection,feature):
-	df = pd.read_sql(f'select * from (select album, date, substr(date, 1, 4) as year, substr(date, 1, 4) / 10 as ten_year_group,round(avg({feature}),2) avg_feature from acoustic_features where artist="David Bowie" group by 1, 2, 3) as source left join (select substr(date, 1, 4) / 10 as ten_year_group, round(avg({feature}),2) trend_feature from acoustic_features group by 1) as trend on trend.ten_year_group = source.ten_year_group', con=conn)
-	#new_df_by_melt = pd.melt(df, id_vars=['year'], value_vars=['energy', 'danceability', 'instrumentalness', 'valence'], var_name='attr')
-	return df
+@profiling.timed
+def get_recommendations(conn: ConnectionPool, decades, energy, valence, danceability, sort_by, mode='range', artist=DEFAULT_ARTIST, n=10):
+  # top n of search_songs without duplicates, from the shared mood search cache when
+  # anyone asked for the same slider positions before (see result_cache.py)
+  key = mood_search_key(conn, decades, energy, valence, danceability, sort_by, mode, artist)
+  def compute():
+    bounds = [dequantize(quantize(values)) for values in (energy, valence, danceability)]
+    df = search_songs(conn, decades, *bounds, sort_by, mode=mode, artist=artist)
+    return remove_duplicates(df).head(n)
+  return mood_cache.get_or_compute(key + (n,), compute)
 
-def display_data(conn: Connection):
+@profiling.timed
+def get_similar_tracks(conn: ConnectionPool, track_id, k=10):
+  # "more like this": the k most similar tracks of one track, most similar first, from
+  # the similar_tracks table (built offline by similar.py, empty frame until then)
+  if not has_table(conn, 'similar_tracks'):
+    return pd.DataFrame(columns=['id', 'song', 'artist', 'album', 'date', 'score'])
+  sql_query = '''
+    select a.id, a.song, a.artist, a.album, a.date, s.score
+    from similar_tracks s join acoustic_features a on a.id = s.neighbour_id
+    where s.track_id = ?
+    order by s.rank
+    limit ?
+  '''
+  return conn.read_sql(sql_query, (int(track_id), k))
+
+def display_data(conn: ConnectionPool):
   # st.dataframe(get_data(conn))
   if st.checkbox("display raw data"):
     st.dataframe(get_data(conn))
     
+@profiling.timed
 def remove_duplicates(df):
-  song_list = []
-  new_df = None
-
-  i = 0
-  for row in df.values:
-    song_name = row[0]
-
-    if '-' in song_name:
-      song_name = song_name.split(' - ')[0]
-      df.at[i, 'song'] = song_name # rewrite song name
-
-    if song_name not in song_list:
-      song_list.append(song_name)
-
-      if new_df is None:
-        new_df = df[i:i+1]
-      else:
-        new_df = pd.concat([new_df, df[i:i+1]])
-    i += 1
-
-  return new_df
\ No newline at end of file
+  # drop " - Remastered 2015" style suffixes, then keep the first row per song
+  # (case / whitespace insensitive). returns a new frame, df is left untouched.
+  songs = df['song'].str.split(' - ', n=1).str[0]
+  key = songs.str.strip().str.casefold()
+  keep = ~key.duplicated()
+  return df.loc[keep].assign(song=songs[keep])